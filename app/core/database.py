@@ -2,36 +2,215 @@ import sqlite3
 import logging
 import os
 import math
-from urllib.parse import urlparse, parse_qs
+import re
+from urllib.parse import unquote_plus
 import json
-from datetime import datetime, timezone, timedelta, time
+import atexit
+from itertools import islice
+import threading
+from datetime import datetime, timezone, timedelta
 
 DB_FILE = "db/products.db"
 KEYWORDS_FILE = "db/keywords.json"
+# init_db のマイグレーション内容のバージョン。PRAGMA user_version がこの値と一致するDBではマイグレーションを省略する。
+# テーブル・カラム・インデックス・トリガーなど、init_db の処理を変更したら必ず1つ上げること
+SCHEMA_VERSION = 4
 
 
-def get_db_connection():
-    """データベース接続を取得する"""
+def _to_epoch_seconds(dt: datetime) -> int:
+    """
+    タイムゾーンなしの日時を、SQLiteの strftime('%s', ...) と同じ基準 (UTCとみなす) でUNIX秒に変換する。
+    *_ts_epoch 生成列と比較する値はこの関数で変換すること。
+    """
+    return int(dt.replace(tzinfo=timezone.utc).timestamp())
+
+# 日本標準時。created_at などのタイムスタンプはJSTのISO形式で保存する
+JST = timezone(timedelta(hours=9))
+
+
+def _now_jst_iso() -> str:
+    """JSTの現在時刻をISO 8601形式の文字列で返す"""
+    return datetime.now(JST).isoformat()
+
+# journal_mode=WAL はDBファイルに永続化されるため、プロセスごとに1度だけ設定すればよい
+_wal_initialized = False
+
+# --- スレッドローカルな接続プール ---
+# 呼び出しごとに接続を開閉すると、PRAGMA設定やスキーマ読み込みのコストが毎回かかる。
+# スレッドごとに1本の接続を使い回す。
+_local = threading.local()
+_pool_lock = threading.Lock()
+_pool_connections = []  # [(thread, conn), ...] 生存確認と一括クローズ用
+_pool_generation = 0  # close_all_connections() で加算され、各スレッドに再接続させる
+
+
+class _PooledConnection(sqlite3.Connection):
+    """
+    プールで管理する接続。
+    既存の呼び出し側が conn.close() を呼んでも接続が閉じないよう、close() は何もしない。
+    実際のクローズは _close() で行う。
+    """
+    def close(self):
+        pass
+
+    def _close(self):
+        super().close()
+
+
+def _optimize_connection(conn):
+    """接続中に実行したクエリをもとに、必要なテーブルだけ統計情報 (ANALYZE) を更新する"""
+    conn.execute("PRAGMA analysis_limit=400")
+    conn.execute("PRAGMA optimize")
+
+
+def _prune_dead_thread_connections():
+    """終了したスレッドの接続を閉じる (run_threaded はジョブごとにスレッドを作るため)。_pool_lock 取得済みで呼ぶこと"""
+    alive = []
+    for thread, conn in _pool_connections:
+        if thread.is_alive():
+            alive.append((thread, conn))
+        else:
+            try:
+                # 一括書き込みを行うのは主にジョブのスレッドのため、閉じる前に統計情報を更新しておく
+                # (プロセス終了時の close_all_connections まで待つと、常駐中は古い統計のままになる)
+                _optimize_connection(conn)
+                conn._close()
+            except sqlite3.Error:
+                pass
+    _pool_connections[:] = alive
+
+
+def close_all_connections():
+    """プール内の全接続を閉じる。DBファイルの差し替え前やプロセス終了時に呼ぶ"""
+    global _pool_generation
+    with _pool_lock:
+        last_index = len(_pool_connections) - 1
+        for i, (_, conn) in enumerate(_pool_connections):
+            try:
+                _optimize_connection(conn)
+                if i == last_index:
+                    # 他の接続を閉じた後、WALの内容をDB本体へ書き戻してWALファイルを切り詰める
+                    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                conn._close()
+            except sqlite3.Error as e:
+                logging.warning(f"データベース接続のクローズに失敗しました: {e}")
+        _pool_connections.clear()
+        _pool_generation += 1
+
+
+atexit.register(close_all_connections)
+
+
+def _open_connection():
+    """新しい接続を開き、PRAGMAを設定する"""
+    global _wal_initialized
     # データベースファイルが格納されるディレクトリの存在を確認し、なければ作成する
     db_dir = os.path.dirname(DB_FILE)
     os.makedirs(db_dir, exist_ok=True)
-    conn = sqlite3.connect(DB_FILE)
+    # check_same_thread=False: 終了スレッドの接続を別スレッドから閉じられるようにする。
+    # 接続自体はスレッドローカルにのみ保持し、スレッド間で共有しない。
+    # cached_statements: 接続を使い回すため、パース済みステートメントのキャッシュを既定 (128) より大きくする
+    conn = sqlite3.connect(DB_FILE, factory=_PooledConnection, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    if not _wal_initialized:
+        # WAL: 読み取りと書き込みが互いにブロックしない
+        conn.execute("PRAGMA journal_mode=WAL")
+        _wal_initialized = True
+    # 以下は接続ごとの設定
+    # WALモードでは synchronous=NORMAL でもコミット済みデータの整合性は保たれ、コミット毎のfsyncを省ける
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")  # 約64MB
+    conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+    # チェックポイント後に残るWALファイルの大きさを64MBまでに抑える
+    conn.execute("PRAGMA journal_size_limit=67108864")
+    conn.execute("PRAGMA foreign_keys=ON")
     return conn
 
+
+def get_db_connection():
+    """
+    データベース接続を取得する。
+    接続はスレッドごとに再利用される。書き込みは `with conn:` で囲み、必ずコミット/ロールバックすること。
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "generation", None) == _pool_generation:
+        return conn
+    conn = _open_connection()
+    with _pool_lock:
+        _prune_dead_thread_connections()
+        _pool_connections.append((threading.current_thread(), conn))
+        _local.conn = conn
+        _local.generation = _pool_generation
+    return conn
+
+def _get_table_columns(cursor, table: str) -> set[str]:
+    """テーブルのカラム名の集合を返す (生成列は table_info に現れないため、table_xinfo で確認する)"""
+    return {row['name'] for row in cursor.execute(f"PRAGMA table_xinfo({table})")}
+
+def _add_column_if_absent(cursor, table: str, columns_cache: dict[str, set[str]], column_name: str, column_type: str, update_query: str | None = None):
+    """
+    カラムが存在しなければ追加する (init_db のマイグレーション用)。
+    columns_cache[table] は既存カラムの集合で、ALTER に成功したカラムを追加して以降のチェックと整合させる。
+    :param update_query: カラム追加後に既存データを埋めるためのSQL
+    """
+    existing_columns = columns_cache[table]
+    if column_name in existing_columns:
+        return
+    try:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column_name} {column_type}")
+        existing_columns.add(column_name)
+        if update_query:
+            cursor.execute(update_query)
+        logging.debug(f"{table}テーブルに '{column_name}' カラムを追加しました。")
+    except sqlite3.Error as e:
+        logging.error(f"'{column_name}' カラムの追加に失敗しました: {e}")
+
+# 削除時の件数トリガー。DELETE トリガーがあると全件削除でも1行ずつの削除になるため、
+# delete_all_products では一時的に削除して作り直す
+_PRODUCT_STATUS_COUNT_DELETE_TRIGGER_SQL = """
+    CREATE TRIGGER IF NOT EXISTS trg_products_status_count_delete AFTER DELETE ON products
+    BEGIN
+        UPDATE product_status_counts SET count = count - 1 WHERE status = OLD.status;
+    END
+"""
+
+def _rebuild_product_status_counts(cursor):
+    """ステータス別件数の集計テーブルを products から作り直す"""
+    cursor.execute("DELETE FROM product_status_counts")
+    cursor.execute("INSERT INTO product_status_counts (status, count) SELECT status, COUNT(*) FROM products GROUP BY status")
+
+def _optimize_on_startup(conn):
+    """
+    起動時にも、統計情報が古くなったテーブルがあれば ANALYZE しておく (0x10000: 全テーブルを確認対象にする)。
+    プロセスが close_all_connections を通らずに終了した場合でも、次回起動時に統計情報が更新されるようにする
+    """
+    conn.execute("PRAGMA analysis_limit=400")
+    conn.execute("PRAGMA optimize=0x10002")
+
 def init_db():
     """データベースを初期化し、テーブルを作成する"""
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
+        # スキーマが最新の場合は、マイグレーション処理全体を省略する (起動時の統計情報の更新は行う)
+        if conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+            _optimize_on_startup(conn)
+            logging.debug("データベースのスキーマは最新です。")
+            return
+
         cursor = conn.cursor()
+        # DDLを含むすべてのマイグレーションを1トランザクションで実行し、最後に1度だけコミットする
+        # (sqlite3モジュールはDDLの前に自動でBEGINしないため明示する。executescript() は途中でCOMMITするため使わない)
+        cursor.execute("BEGIN")
 
         # 最初にproductsテーブルが存在しない場合を作成する
         # これにより、DBファイルがなくても後続のPRAGMA文でエラーが発生しなくなる
+        products_existed = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products'").fetchone() is not None
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS products (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL, -- 商品キャプション
-                url TEXT NOT NULL, -- UNIQUE制約は後で確認・適用する
+                url TEXT NOT NULL UNIQUE, -- 既存DBのUNIQUE制約は後で確認・適用する
                 image_url TEXT,
                 post_url TEXT,
                 room_url TEXT,
@@ -47,78 +226,111 @@ def init_db():
             )
         ''')
 
-        # --- URLにUNIQUE制約があるか確認し、なければテーブルを再構築する ---
-        is_url_unique = False
-        # PRAGMA index_listはテーブルのインデックス情報を返す
+        # --- URLにUNIQUE制約があるか確認し、なければユニークインデックスを作成する ---
+        # 今回作成したテーブルは UNIQUE 付きで作成済みのため、確認するのは既存のテーブルのみ
         # UNIQUE制約は自動的にユニークインデックスを作成する
-        cursor.execute("PRAGMA index_list(products)")
-        for index in cursor.fetchall():
-            if index['unique']:
-                # そのユニークインデックスがどのカラムに対するものか確認
-                cursor.execute(f"PRAGMA index_info({index['name']})")
-                for col in cursor.fetchall():
-                    if col['name'] == 'url':
-                        is_url_unique = True
-                        break
-            if is_url_unique:
-                break
-        
+        # pragma_index_list / pragma_index_info を結合し、urlを含むユニークインデックスの有無を1回のクエリで確認する
+        is_url_unique = True
+        if products_existed:
+            cursor.execute("""
+                SELECT 1 FROM pragma_index_list('products') AS il
+                JOIN pragma_index_info(il.name) AS ii
+                WHERE il."unique" = 1 AND ii.name = 'url'
+                LIMIT 1
+            """)
+            is_url_unique = cursor.fetchone() is not None
+
         if not is_url_unique:
-            logging.warning("productsテーブルのurlカラムにUNIQUE制約がありません。テーブルを再構築します。")
-            cursor.execute("ALTER TABLE products RENAME TO products_old")
-            logging.debug("既存のテーブルを 'products_old' にリネームしました。")
-            cursor.execute('''CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, url TEXT NOT NULL UNIQUE, image_url TEXT, post_url TEXT, room_url TEXT, shop_name TEXT, ai_caption TEXT, procurement_keyword TEXT, status TEXT NOT NULL DEFAULT '生情報取得', error_message TEXT, created_at TIMESTAMP, post_url_updated_at TIMESTAMP, ai_caption_created_at TIMESTAMP, posted_at TIMESTAMP)''')
-            logging.debug("新しい 'products' テーブルを作成しました。")
-            # 古いテーブルから新しいテーブルへデータをコピー（重複URLは無視される）
-            cursor.execute("INSERT OR IGNORE INTO products(id, name, url, image_url, post_url, room_url, ai_caption, procurement_keyword, status, error_message, created_at, post_url_updated_at, ai_caption_created_at, posted_at) SELECT id, name, url, image_url, post_url, NULL, ai_caption, procurement_keyword, status, error_message, created_at, post_url_updated_at, ai_caption_created_at, posted_at FROM products_old")
-            logging.debug("データを新しいテーブルにコピーしました。")
-            cursor.execute("DROP TABLE products_old")
-            logging.debug("'products_old' テーブルを削除しました。")
+            # テーブルを作り直してコピーする代わりに、重複行を削除してからユニークインデックスを作成する
+            # (UNIQUE制約と同じくユニークインデックスで重複が防がれ、ON CONFLICT(url) の対象にもなる)
+            # 重複URLは最も古い (idが最小の) 行を残す
+            logging.warning("productsテーブルのurlカラムにUNIQUE制約がありません。重複を削除してユニークインデックスを作成します。")
+            cursor.execute("""
+                DELETE FROM products
+                WHERE url IS NOT NULL
+                  AND id NOT IN (SELECT MIN(id) FROM products WHERE url IS NOT NULL GROUP BY url)
+            """)
+            logging.debug(f"重複したURLの商品を{cursor.rowcount}件削除しました。")
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_url_unique ON products(url)")
+            logging.debug("ユニークインデックス 'idx_products_url_unique' を作成しました。")
 
         # --- カラム存在チェックと追加（マイグレーション処理） ---
         # 他の処理よりも先に実行することで、古いDBスキーマでもエラーなく動作するようにする
-        def add_column_if_not_exists(cursor, column_name, column_type, update_query=None):
-            cursor.execute("PRAGMA table_info(products)")
-            columns = [row['name'] for row in cursor.fetchall()]
-            if column_name not in columns:
-                try:
-                    cursor.execute(f"ALTER TABLE products ADD COLUMN {column_name} {column_type}")
-                    if update_query:
-                        cursor.execute(update_query)
-                    logging.debug(f"productsテーブルに '{column_name}' カラムを追加しました。")
-                except sqlite3.Error as e:
-                    logging.error(f"'{column_name}' カラムの追加に失敗しました: {e}")
-
-        # --- user_engagementテーブルのマイグレーション ---
-        def add_column_to_engagement_if_not_exists(cursor, column_name, column_type):
-            cursor.execute("PRAGMA table_info(user_engagement)")
-            columns = [row['name'] for row in cursor.fetchall()]
-            if column_name not in columns:
-                try:
-                    cursor.execute(f"ALTER TABLE user_engagement ADD COLUMN {column_name} {column_type}")
-                    logging.debug(f"user_engagementテーブルに '{column_name}' カラムを追加しました。")
-                except sqlite3.Error as e:
-                    logging.error(f"'{column_name}' カラムの追加に失敗しました: {e}")
-
+        # 既存カラムはテーブルごとに1度だけ取得し、_add_column_if_absent で共有する
+        columns_cache = {'products': _get_table_columns(cursor, 'products')}
         # タイプミスを修正し、重複していた行を削除
-        add_column_if_not_exists(cursor, 'post_url', 'TEXT')
-
-        add_column_if_not_exists(cursor, 'image_url', 'TEXT')
-        add_column_if_not_exists(cursor, 'created_at', 'TIMESTAMP', 
-                                 "UPDATE products SET created_at = COALESCE(post_url_updated_at, ai_caption_created_at, posted_at, CURRENT_TIMESTAMP) WHERE created_at IS NULL")
-        add_column_if_not_exists(cursor, 'post_url_updated_at', 'TIMESTAMP', 
-                                 "UPDATE products SET post_url_updated_at = COALESCE(ai_caption_created_at, posted_at) WHERE post_url_updated_at IS NULL AND post_url IS NOT NULL")
-        add_column_if_not_exists(cursor, 'ai_caption', 'TEXT')
-        add_column_if_not_exists(cursor, 'ai_caption_created_at', 'TIMESTAMP', 
-                                 "UPDATE products SET ai_caption_created_at = posted_at WHERE ai_caption_created_at IS NULL AND ai_caption IS NOT NULL")
-        add_column_if_not_exists(cursor, 'posted_at', 'TIMESTAMP')
-        add_column_if_not_exists(cursor, 'procurement_keyword', 'TEXT')
-        add_column_if_not_exists(cursor, 'error_message', 'TEXT')
+        _add_column_if_absent(cursor, 'products', columns_cache, 'post_url', 'TEXT')
+
+        _add_column_if_absent(cursor, 'products', columns_cache, 'image_url', 'TEXT')
+        _add_column_if_absent(cursor, 'products', columns_cache, 'created_at', 'TIMESTAMP', 
+                              "UPDATE products SET created_at = COALESCE(post_url_updated_at, ai_caption_created_at, posted_at, CURRENT_TIMESTAMP) WHERE created_at IS NULL")
+        _add_column_if_absent(cursor, 'products', columns_cache, 'post_url_updated_at', 'TIMESTAMP', 
+                              "UPDATE products SET post_url_updated_at = COALESCE(ai_caption_created_at, posted_at) WHERE post_url_updated_at IS NULL AND post_url IS NOT NULL")
+        _add_column_if_absent(cursor, 'products', columns_cache, 'ai_caption', 'TEXT')
+        _add_column_if_absent(cursor, 'products', columns_cache, 'ai_caption_created_at', 'TIMESTAMP', 
+                              "UPDATE products SET ai_caption_created_at = posted_at WHERE ai_caption_created_at IS NULL AND ai_caption IS NOT NULL")
+        _add_column_if_absent(cursor, 'products', columns_cache, 'posted_at', 'TIMESTAMP')
+        _add_column_if_absent(cursor, 'products', columns_cache, 'procurement_keyword', 'TEXT')
+        _add_column_if_absent(cursor, 'products', columns_cache, 'error_message', 'TEXT')
 
         # 優先度カラムを追加
-        add_column_if_not_exists(cursor, 'priority', 'INTEGER', "UPDATE products SET priority = 0")
-        add_column_if_not_exists(cursor, 'shop_name', 'TEXT')
-        add_column_if_not_exists(cursor, 'room_url', 'TEXT')
+        _add_column_if_absent(cursor, 'products', columns_cache, 'priority', 'INTEGER', "UPDATE products SET priority = 0")
+        _add_column_if_absent(cursor, 'products', columns_cache, 'shop_name', 'TEXT')
+        _add_column_if_absent(cursor, 'products', columns_cache, 'room_url', 'TEXT')
+        # ステータス別の一覧・件数取得用のインデックス
+        # - 投稿準備完了/在庫一覧: WHERE status = ? ORDER BY priority DESC, created_at
+        # - 投稿URL取得/投稿文作成/エラー一覧: WHERE status = ? ORDER BY created_at
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_status_priority_created ON products(status, priority DESC, created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_status_created ON products(status, created_at)")
+        # - 投稿対象の取得: 投稿URL・投稿文が揃った行だけを持つ部分インデックスで、ソートも行単位の絞り込みも不要にする
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_products_ready ON products(status, priority DESC, created_at)
+            WHERE status = '投稿準備完了' AND post_url IS NOT NULL AND ai_caption IS NOT NULL
+        """)
+        # - 在庫一覧: status NOT IN (...) は範囲検索にできないため、並び順のインデックスを走査して一時ソートを避ける
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_priority_created ON products(priority DESC, created_at)")
+        # - 投稿済一覧: WHERE status = '投稿済' ORDER BY posted_at DESC
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_status_posted ON products(status, posted_at DESC)")
+        # - ショップ別集計: 投稿済かつショップ名ありの行だけを shop_name 順に持つ部分インデックスで、
+        #   GROUP BY をインデックスの走査だけで済ませる。WHERE はクエリ側と同一にしておくこと
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_products_posted_shop ON products(shop_name)
+            WHERE status = '投稿済' AND shop_name IS NOT NULL AND shop_name != ''
+        """)
+        # - 投稿URLでの存在確認: WHERE post_url = ? AND post_url IS NOT NULL
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_post_url ON products(post_url) WHERE post_url IS NOT NULL")
+        # - 再利用対象の取得: WHERE procurement_keyword = '再コレ再利用' AND post_url ...
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_procurement_post_url ON products(procurement_keyword, post_url)")
+        # - 再収集時の重複判定: スキーム (http/https) を除いたURLの前方一致。式はクエリ側と同一にしておくこと
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_url_without_scheme ON products(SUBSTR(url, INSTR(url, '://') + 3))")
+
+        # --- ステータス別件数の集計テーブル ---
+        # get_product_count_by_status が毎回 products を全件走査しないよう、件数をトリガーで差分更新する
+        cursor.execute("CREATE TABLE IF NOT EXISTS product_status_counts (status TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)")
+        # トリガーがない場合 (初回、または既存DBに初めて適用する場合) は件数を作り直す
+        has_status_triggers = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_products_status_count_insert'"
+        ).fetchone()
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_products_status_count_insert AFTER INSERT ON products
+            BEGIN
+                INSERT INTO product_status_counts (status, count) VALUES (NEW.status, 1)
+                ON CONFLICT(status) DO UPDATE SET count = count + 1;
+            END
+        """)
+        cursor.execute(_PRODUCT_STATUS_COUNT_DELETE_TRIGGER_SQL)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_products_status_count_update AFTER UPDATE OF status ON products
+            WHEN OLD.status IS NOT NEW.status
+            BEGIN
+                UPDATE product_status_counts SET count = count - 1 WHERE status = OLD.status;
+                INSERT INTO product_status_counts (status, count) VALUES (NEW.status, 1)
+                ON CONFLICT(status) DO UPDATE SET count = count + 1;
+            END
+        """)
+        if not has_status_triggers:
+            _rebuild_product_status_counts(cursor)
+            logging.debug("ステータス別件数の集計テーブルを作成しました。")
         # `proNOWucts` のタイプミスがあった行は削除
 
         # --- user_engagement テーブルの作成 ---
@@ -147,23 +359,78 @@ def init_db():
                 last_commented_post_url TEXT
             )
         ''')
-        add_column_to_engagement_if_not_exists(cursor, 'last_engagement_error', 'TEXT')
+        columns_cache['user_engagement'] = _get_table_columns(cursor, 'user_engagement')
+        _add_column_if_absent(cursor, 'user_engagement', columns_cache, 'last_engagement_error', 'TEXT')
         logging.debug("user_engagementテーブルが正常に初期化されました。")
 
-        add_column_to_engagement_if_not_exists(cursor, 'ai_prompt_updated_at', 'TEXT')
-        add_column_to_engagement_if_not_exists(cursor, 'comment_generated_at', 'TEXT')
-        add_column_to_engagement_if_not_exists(cursor, 'recent_follow_count', 'INTEGER')
-        add_column_to_engagement_if_not_exists(cursor, 'last_commented_post_url', 'TEXT')
-
-        def add_column_to_my_post_comments_if_not_exists(cursor, column_name, column_type):
-            cursor.execute("PRAGMA table_info(my_post_comments)")
-            columns = [row['name'] for row in cursor.fetchall()]
-            if column_name not in columns:
-                try:
-                    cursor.execute(f"ALTER TABLE my_post_comments ADD COLUMN {column_name} {column_type}")
-                    logging.debug(f"my_post_commentsテーブルに '{column_name}' カラムを追加しました。")
-                except sqlite3.Error as e:
-                    logging.error(f"'{column_name}' カラムの追加に失敗しました: {e}")
+        # --- ユーザー名検索用の全文検索インデックス (FTS5, trigram) ---
+        # 名前は日本語が多く単語区切りがないため、部分一致検索ができる trigram トークナイザを使用する
+        # 注意: user_engagement の主キーは TEXT のため、content_rowid の rowid は暗黙の値 (INTEGER PRIMARY KEY の別名ではない)。
+        # VACUUM やダンプからの復元では rowid が振り直されることがあり、そのままでは検索結果が別のユーザーを指してしまう。
+        # VACUUM・復元を行う処理では、必ず最後に 'rebuild' を実行して索引を作り直すこと
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_engagement_fts'")
+        fts_existed = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS user_engagement_fts USING fts5(
+                name, content='user_engagement', content_rowid='rowid', tokenize='trigram'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS user_engagement_fts_ai AFTER INSERT ON user_engagement BEGIN
+                INSERT INTO user_engagement_fts(rowid, name) VALUES (new.rowid, new.name);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS user_engagement_fts_ad AFTER DELETE ON user_engagement BEGIN
+                INSERT INTO user_engagement_fts(user_engagement_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS user_engagement_fts_au AFTER UPDATE OF name ON user_engagement BEGIN
+                INSERT INTO user_engagement_fts(user_engagement_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+                INSERT INTO user_engagement_fts(rowid, name) VALUES (new.rowid, new.name);
+            END
+        ''')
+        if not fts_existed:
+            # 既存データからインデックスを構築する
+            cursor.execute("INSERT INTO user_engagement_fts(user_engagement_fts) VALUES ('rebuild')")
+            logging.debug("user_engagement_fts を作成し、既存データからインデックスを構築しました。")
+
+        _add_column_if_absent(cursor, 'user_engagement', columns_cache, 'ai_prompt_updated_at', 'TEXT')
+        _add_column_if_absent(cursor, 'user_engagement', columns_cache, 'comment_generated_at', 'TEXT')
+        _add_column_if_absent(cursor, 'user_engagement', columns_cache, 'recent_follow_count', 'INTEGER')
+        _add_column_if_absent(cursor, 'user_engagement', columns_cache, 'last_commented_post_url', 'TEXT')
+        # コメント対象ユーザー (get_users_for_commenting) 用のカバリング部分インデックス
+        # ORDER BY recent_action_timestamp DESC + LIMIT をテーブル本体を参照せずインデックスのみで処理できるよう、
+        # _ENGAGEMENT_LIST_COLUMNS の全カラムを含める。WHERE句はクエリ側と同一にしておくこと
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ue_comment_cover ON user_engagement(
+                recent_action_timestamp DESC, id, name, profile_page_url, profile_image_url, like_count, follow_count,
+                is_following, latest_action_timestamp, recent_like_count, recent_follow_count,
+                comment_text, last_commented_at, last_commented_post_url, last_engagement_error
+            )
+            WHERE (is_following = 1 AND recent_follow_count > 0 AND recent_like_count >= 1) OR (recent_like_count >= 3)
+        """)
+        # AIコメント生成待ちユーザー (get_users_for_ai_comment_creation) の部分インデックス
+        # WHERE句はクエリ側と同一にしておくこと (一致しないとプランナーが使用しない)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ue_ai_pending ON user_engagement(ai_prompt_updated_at)
+            WHERE ai_prompt_message IS NOT NULL AND ai_prompt_message != ''
+                AND (comment_generated_at IS NULL OR ai_prompt_updated_at > comment_generated_at)
+        """)
+        # 累計いいね数順ソート用の生成列とインデックス (ORDER BY で式を評価・ソートせずに済むようにする)
+        _add_column_if_absent(cursor, 'user_engagement', columns_cache, 'total_like_count', 'INTEGER GENERATED ALWAYS AS (like_count + recent_like_count) VIRTUAL')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ue_total_likes ON user_engagement(total_like_count DESC)")
+        # 期間指定の検索用に、アクション日時をUNIX秒 (整数) に変換した生成列とインデックス
+        _add_column_if_absent(cursor, 'user_engagement', columns_cache, 'recent_action_ts_epoch', "INTEGER GENERATED ALWAYS AS (CAST(strftime('%s', recent_action_timestamp) AS INTEGER)) VIRTUAL")
+        _add_column_if_absent(cursor, 'user_engagement', columns_cache, 'latest_action_ts_epoch', "INTEGER GENERATED ALWAYS AS (CAST(strftime('%s', latest_action_timestamp) AS INTEGER)) VIRTUAL")
+        # 未コミットのアクションが残るユーザー (get_stale_user_ids_for_commit) 用の部分インデックス
+        # WHERE句はクエリ側と同一にしておくこと
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ue_stale_pending ON user_engagement(recent_action_ts_epoch)
+            WHERE recent_like_count > 0 OR recent_collect_count > 0 OR recent_comment_count > 0 OR recent_follow_count > 0
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ue_latest_ts_epoch ON user_engagement(latest_action_ts_epoch)")
 
         # --- my_post_comments テーブルの作成 ---
         cursor.execute('''
@@ -188,91 +455,147 @@ def init_db():
 
         # --- my_post_comments テーブルのマイグレーション ---
         # 過去のバージョンでDBが作成された場合でも、カラムがなければ追加する
-        add_column_to_my_post_comments_if_not_exists(cursor, 'user_page_url', 'TEXT')
-        add_column_to_my_post_comments_if_not_exists(cursor, 'user_image_url', 'TEXT')
-        add_column_to_my_post_comments_if_not_exists(cursor, 'reply_generated_at', 'TIMESTAMP')
-        add_column_to_my_post_comments_if_not_exists(cursor, 'reply_posted_at', 'TIMESTAMP')
-        add_column_to_my_post_comments_if_not_exists(cursor, 'like_back_count', 'INTEGER')
-        add_column_to_my_post_comments_if_not_exists(cursor, 'last_like_back_at', 'TIMESTAMP')
+        columns_cache['my_post_comments'] = _get_table_columns(cursor, 'my_post_comments')
+        _add_column_if_absent(cursor, 'my_post_comments', columns_cache, 'user_page_url', 'TEXT')
+        _add_column_if_absent(cursor, 'my_post_comments', columns_cache, 'user_image_url', 'TEXT')
+        _add_column_if_absent(cursor, 'my_post_comments', columns_cache, 'reply_generated_at', 'TIMESTAMP')
+        _add_column_if_absent(cursor, 'my_post_comments', columns_cache, 'reply_posted_at', 'TIMESTAMP')
+        _add_column_if_absent(cursor, 'my_post_comments', columns_cache, 'like_back_count', 'INTEGER')
+        _add_column_if_absent(cursor, 'my_post_comments', columns_cache, 'last_like_back_at', 'TIMESTAMP')
+
+        # my_post_comments 用のインデックス
+        # - 投稿ごとの最新コメント (GROUP BY post_detail_url の MAX(post_timestamp)) / 投稿単位の未返信コメント・返信の一括更新
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mpc_post_ts ON my_post_comments(post_detail_url, post_timestamp)")
+        # - 未返信コメントの一覧: WHERE reply_generated_at IS NULL ORDER BY post_timestamp DESC
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_mpc_unreplied ON my_post_comments(post_timestamp)
+            WHERE reply_generated_at IS NULL
+        """)
+        # - 生成済み・未投稿の返信: WHERE reply_text IS NOT NULL AND reply_posted_at IS NULL AND reply_generated_at >= ?
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_mpc_unposted ON my_post_comments(reply_generated_at)
+            WHERE reply_text IS NOT NULL AND reply_posted_at IS NULL
+        """)
+        # - ユーザー単位の集計・いいね返し: WHERE/GROUP BY user_page_url
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mpc_user_page_ts ON my_post_comments(user_page_url, post_timestamp)")
 
         # --- 既存タイムスタンプのフォーマットをISO 8601に統一するマイグレーション処理 ---
         # この処理は一度実行されると、次回以降は更新対象がなくなる
         timestamp_columns = ['created_at', 'post_url_updated_at', 'ai_caption_created_at', 'posted_at']
         for col in timestamp_columns:
-            # 'YYYY-MM-DD HH:MM:SS' 形式のレコードを探す
-            cursor.execute(f"SELECT id, {col} FROM products WHERE {col} LIKE '____-__-__ __:__:__'")
-            records_to_update = cursor.fetchall()
-            if records_to_update:
-                logging.debug(f"'{col}' カラムの古いタイムスタンプ形式をISO 8601に変換します... (対象: {len(records_to_update)}件)")
-                updates = []
-                for row in records_to_update:
-                    try:
-                        # 文字列をdatetimeオブジェクトに変換し、ISO形式の文字列に再変換
-                        dt_obj = datetime.strptime(row[col], '%Y-%m-%d %H:%M:%S')
-                        updates.append((dt_obj.isoformat(), row['id']))
-                    except (ValueError, TypeError):
-                        continue # 不正な形式のデータはスキップ
-                if updates:
-                    cursor.executemany(f"UPDATE products SET {col} = ? WHERE id = ?", updates)
-
-
+            # 'YYYY-MM-DD HH:MM:SS' 形式のレコードを、SQL内で 'YYYY-MM-DDTHH:MM:SS' に変換する
+            # julianday() を経由して元の値に戻らない (2月30日などの不正な日時) データはスキップする
+            cursor.execute(f"""
+                UPDATE products SET {col} = substr({col}, 1, 10) || 'T' || substr({col}, 12, 8)
+                WHERE {col} LIKE '____-__-__ __:__:__' AND datetime(julianday({col})) = {col}
+            """)
+            if cursor.rowcount > 0:
+                logging.debug(f"'{col}' カラムの古いタイムスタンプ形式をISO 8601に変換しました。(対象: {cursor.rowcount}件)")
+
+        # --- 統計情報が未作成なら ANALYZE し、プランナが上記のインデックスを選べるようにする ---
+        # 以降の更新は close_all_connections の PRAGMA optimize に任せる
+        has_stat_table = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").fetchone()
+        if not has_stat_table or not cursor.execute("SELECT 1 FROM sqlite_stat1 WHERE tbl = 'products' LIMIT 1").fetchone():
+            cursor.execute("ANALYZE products")
+            logging.debug("productsテーブルの統計情報を作成しました。")
+
+        # PRAGMA はパラメータを使えないため、整数に変換した値を埋め込む
+        cursor.execute(f"PRAGMA user_version = {int(SCHEMA_VERSION)}")
         conn.commit()
-        conn.close()
+        _optimize_on_startup(conn)
         logging.debug("データベースが正常に初期化されました。")
     except sqlite3.Error as e:
+        # 途中までのマイグレーションが接続に残らないようにロールバックする
+        conn.rollback()
         logging.error(f"データベース初期化エラー: {e}")
-def get_all_error_products():
-    """ステータスが「エラー」の商品をすべて取得する"""
+
+def _rows_as_dicts(cursor) -> list[dict]:
+    """
+    実行済みカーソルの結果を辞書のリストにする。
+    カラム名は cursor.description から1度だけ取り出すため、row_factory を None にしたカーソル
+    (行がタプルで返る) と組み合わせて使い、sqlite3.Row の生成と行ごとのキー参照を省く。
+    """
+    columns = [d[0] for d in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def get_all_error_products() -> list[dict]:
+    """
+    ステータスが「エラー」の商品をすべて取得する。
+    JSONにそのまま渡せるよう、辞書のリストを返す
+    """
     conn = get_db_connection()
     cur = conn.cursor()
+    cur.row_factory = None
     
     # ステータスが'エラー'のものをすべて取得し、作成日が新しい順にソート
     query = "SELECT * FROM products WHERE status = 'エラー' ORDER BY created_at DESC"
     cur.execute(query)
-    products = [dict(row) for row in cur.fetchall()]
-    conn.close()
-    return products
+    return _rows_as_dicts(cur)
+
+def _get_status_count(status: str) -> int:
+    """指定ステータスの商品件数を、トリガーで維持している集計テーブル (product_status_counts) から取得する"""
+    conn = get_db_connection()
+    row = conn.execute("SELECT count FROM product_status_counts WHERE status = ?", (status,)).fetchone()
+    return row[0] if row else 0
+
+def get_error_product_count() -> int:
+    """ステータスが「エラー」の商品の件数を取得する"""
+    return _get_status_count('エラー')
+
+def _limit_param(limit) -> int:
+    """
+    LIMIT ? にバインドする値を返す。limit が未指定 (None/0) の場合は無制限 (-1)。
+    件数をSQL文字列に埋め込まないことで、ステートメントキャッシュが効くようにする。
+    """
+    return int(limit) if limit else -1
 
 def get_all_ready_to_post_products(limit=None):
     """ステータスが「投稿準備完了」の商品をすべて、または指定された件数だけ取得する"""
     # 投稿に必要な情報が確実に存在するもののみを対象とする
     query = """
         SELECT * FROM products WHERE status = '投稿準備完了' AND post_url IS NOT NULL AND ai_caption IS NOT NULL ORDER BY priority DESC, created_at
+        LIMIT ?
     """
-    if limit:
-        query += f" LIMIT {int(limit)}"
     conn = get_db_connection()
-    products = conn.execute(query).fetchall()
-    conn.close()
+    products = conn.execute(query, (_limit_param(limit),)).fetchall()
     return products
 
-def get_product_by_id(product_id):
-    """指定されたIDの商品を1件取得する"""
-    query = "SELECT * FROM products WHERE id = ?"
-    conn = get_db_connection()
-    product = conn.execute(query, (product_id,)).fetchone()
-    conn.close()
-    return dict(product) if product else None
+_GET_PRODUCT_BY_ID_SQL = "SELECT * FROM products WHERE id = ?"
+# IDリストはJSON配列1つとしてバインドし、件数によらずSQL文字列を固定にする
+_GET_PRODUCTS_BY_IDS_SQL = "SELECT * FROM products WHERE id IN (SELECT value FROM json_each(?))"
 
 def get_product_by_id(product_id: int):
     """指定されたIDの商品を1件取得する"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
-    conn.close()
+    product = conn.execute(_GET_PRODUCT_BY_ID_SQL, (product_id,)).fetchone()
     return dict(product) if product else None
 
+def get_products_by_ids(product_ids: list[int]) -> list[dict]:
+    """
+    指定された複数のIDの商品を1回のクエリで取得する。
+    :return: 商品の辞書のリスト (product_ids の順。存在しないIDは含まれない)
+    """
+    if not product_ids:
+        return []
+    conn = get_db_connection()
+    rows = conn.execute(_GET_PRODUCTS_BY_IDS_SQL, (json.dumps(product_ids),)).fetchall()
+    products_by_id = {row['id']: dict(row) for row in rows}
+    return [products_by_id[product_id] for product_id in product_ids if product_id in products_by_id]
+
 def get_all_inventory_products():
-    """在庫確認ページ用に、「投稿済」「エラー」「対象外」以外の商品をすべて取得する"""
+    """
+    在庫確認ページ用に、「投稿済」「エラー」「対象外」以外の商品をすべて取得する。
+    件数が多くなるため、sqlite3.Row のリストは作らずカーソル (イテレータ) を返す。リストが必要な場合は呼び出し側で list() にする。
+    """
     # 投稿準備が完了していない商品も在庫として表示するため、以前の絞り込みを解除
     query = """
         SELECT * FROM products WHERE status NOT IN ('投稿済', 'エラー', '対象外') ORDER BY priority DESC, created_at ASC
     """
     conn = get_db_connection()
-    products = conn.execute(query).fetchall()
-    conn.close()
-    return products
+    return conn.execute(query)
+
+# 投稿済一覧画面で表示に使うカラム (error_message や各種タイムスタンプなど、画面で使わないカラムは読み込まない)
+_POSTED_PRODUCT_COLUMNS = "id, name, url, image_url, post_url, room_url, shop_name, ai_caption, posted_at"
 
 def get_posted_products(page: int = 1, per_page: int = 30, search_term: str = None, start_date: datetime.date = None, end_date: datetime.date = None, room_url_unlinked: bool = False, shop_name: str = None, comment_search_text: str | None = None):
     """
@@ -280,6 +603,8 @@ def get_posted_products(page: int = 1, per_page: int = 30, search_term: str = No
     """
     conn = get_db_connection()
     cursor = conn.cursor()
+    # 結果は辞書のリストで返すため、sqlite3.Row を経由せずタプルから直接作る
+    cursor.row_factory = None
     
     where_clauses = ["status = '投稿済'"]
     params = []
@@ -297,15 +622,16 @@ def get_posted_products(page: int = 1, per_page: int = 30, search_term: str = No
                 params.append(f"{line}%")  # 前方一致
             where_clauses.append("(" + " OR ".join(line_clauses) + ")")
 
+    # posted_at はJSTのISO形式文字列 ('YYYY-MM-DDTHH:MM:SS...+09:00') で保存されているため、
+    # 比較値もISO形式の文字列で渡す (datetimeをそのまま渡すと 'YYYY-MM-DD HH:MM:SS' になり正しく比較できない)
     if start_date:
         where_clauses.append("posted_at >= ?")
-        params.append(start_date)
+        params.append(start_date.isoformat())
 
     if end_date:
         # 終了日はその日の終わりまで含めるため、翌日の0時より前でフィルタリング
-        end_datetime = datetime.combine(end_date, time(23, 59, 59, 999999))
-        where_clauses.append("posted_at <= ?")
-        params.append(end_datetime)
+        where_clauses.append("posted_at < ?")
+        params.append((end_date + timedelta(days=1)).isoformat())
 
     if room_url_unlinked:
         where_clauses.append("(room_url IS NULL OR room_url = '')")
@@ -319,6 +645,8 @@ def get_posted_products(page: int = 1, per_page: int = 30, search_term: str = No
         where_sql = "WHERE " + " AND ".join(where_clauses)
     
     # 総件数を取得
+    # (COUNT(*) OVER() でデータ取得と1回にまとめると、該当する全行をカラムごと一時テーブルに溜めることになるため、
+    #  インデックスだけで数えられる COUNT(*) を別に実行する)
     count_query = f"SELECT COUNT(*) FROM products {where_sql}"
     cursor.execute(count_query, params)
     total_items = cursor.fetchone()[0]
@@ -326,13 +654,12 @@ def get_posted_products(page: int = 1, per_page: int = 30, search_term: str = No
     
     # データを取得
     offset = (page - 1) * per_page
-    data_query = f"SELECT * FROM products {where_sql} ORDER BY posted_at DESC LIMIT ? OFFSET ?"
+    data_query = f"SELECT {_POSTED_PRODUCT_COLUMNS} FROM products {where_sql} ORDER BY posted_at DESC LIMIT ? OFFSET ?"
     data_params = params + [per_page, offset]
     
     cursor.execute(data_query, data_params)
-    products = [dict(row) for row in cursor.fetchall()]
+    products = _rows_as_dicts(cursor)
     
-    conn.close()
     return products, total_pages, total_items
 
 def get_posted_product_shop_summary() -> list[dict]:
@@ -343,6 +670,7 @@ def get_posted_product_shop_summary() -> list[dict]:
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
+        cursor.row_factory = None
         cursor.execute("""
             SELECT shop_name, COUNT(*) as product_count 
             FROM products 
@@ -350,12 +678,10 @@ def get_posted_product_shop_summary() -> list[dict]:
             GROUP BY shop_name 
             ORDER BY product_count DESC, shop_name ASC
         """)
-        return [dict(row) for row in cursor.fetchall()]
+        return _rows_as_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"ショップ別商品数の取得中にエラー: {e}")
         return []
-    finally:
-        conn.close()
 
 def get_reusable_products():
     """
@@ -365,116 +691,106 @@ def get_reusable_products():
     2. post_url があり、room_url がない商品 (投稿失敗の救済)
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""SELECT * FROM products WHERE procurement_keyword = '再コレ再利用'
-           AND post_url IS NOT NULL AND post_url != '' AND (room_url IS NULL OR room_url = '')""")
-        # sqlite3.Rowオブジェクトのリストを返す
-        products = cursor.fetchall()
-        return products
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    cursor.execute("""SELECT * FROM products WHERE procurement_keyword = '再コレ再利用'
+       AND post_url IS NOT NULL AND post_url != '' AND (room_url IS NULL OR room_url = '')""")
+    # sqlite3.Rowオブジェクトのリストを返す
+    products = cursor.fetchall()
+    return products
 
 
 def get_products_for_post_url_acquisition(limit=None):
     """投稿URL取得対象（ステータスが「生情報取得」）の商品を取得する"""
-    query = "SELECT * FROM products WHERE status = '生情報取得' AND (post_url IS NULL OR post_url = '') ORDER BY created_at"
-    if limit:
-        query += f" LIMIT {int(limit)}"
+    query = "SELECT * FROM products WHERE status = '生情報取得' AND (post_url IS NULL OR post_url = '') ORDER BY created_at LIMIT ?"
     conn = get_db_connection()
-    products = conn.execute(query).fetchall()
-    conn.close()
+    products = conn.execute(query, (_limit_param(limit),)).fetchall()
     return products
 
 def get_products_for_caption_creation(limit=None):
     """投稿文作成対象（ステータスが「URL取得済」）の商品を取得する"""
-    query = "SELECT * FROM products WHERE status = 'URL取得済' ORDER BY created_at"
-    if limit:
-        query += f" LIMIT {int(limit)}"
+    query = "SELECT * FROM products WHERE status = 'URL取得済' ORDER BY created_at LIMIT ?"
     conn = get_db_connection()
-    products = conn.execute(query).fetchall()
-    conn.close()
+    products = conn.execute(query, (_limit_param(limit),)).fetchall()
     return products
 
 def get_products_count_for_caption_creation():
     """投稿文作成対象（ステータスが「URL取得済」）の商品件数を取得する"""
-    query = "SELECT COUNT(*) FROM products WHERE status = 'URL取得済'"
-    conn = get_db_connection()
-    count = conn.execute(query).fetchone()[0]
-    conn.close()
-    return count
+    # 複数ステータスの件数が必要な画面では get_product_count_by_status() を1回呼んで使い回すこと
+    return _get_status_count('URL取得済')
 
 def get_product_count_by_status():
     """ステータスごとの商品数を取得する（「対象外」は除く）"""
-    query = "SELECT status, COUNT(*) as count FROM products WHERE status != '対象外' GROUP BY status"
+    # 件数は products へのトリガーで差分更新される集計テーブルから読む (件数0のステータスは含めない)
+    query = "SELECT status, count FROM product_status_counts WHERE status != '対象外' AND count > 0 ORDER BY status"
     conn = get_db_connection()
-    counts = conn.execute(query).fetchall()
-    conn.close()
-    # sqlite3.Rowを辞書に変換
-    return {row['status']: row['count'] for row in counts}
+    # (status, count) のタプルをそのまま辞書にするため、このカーソルでは sqlite3.Row を作らない
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return dict(cursor.execute(query))
+
+# update_product_status 用のクエリ。ステータスごとの違いはCASE式で扱い、1つのSQL文字列にまとめる
+# - 投稿済: 投稿完了日時も記録する
+# - エラー: エラーメッセージを保存する
+# - それ以外: エラーから復帰させる場合などはエラーメッセージをクリアする
+_UPDATE_PRODUCT_STATUS_SQL = """
+    UPDATE products SET
+        status = ?1,
+        posted_at = CASE WHEN ?1 = '投稿済' THEN ?2 ELSE posted_at END,
+        error_message = CASE WHEN ?1 = 'エラー' THEN ?3 ELSE NULL END
+    WHERE id = ?4
+"""
 
 def update_product_status(product_id, status, error_message=None):
     """商品のステータスを更新する。エラーの場合はエラーメッセージも保存する。"""
     conn = get_db_connection()
     try:
-        # JSTのタイムゾーンを定義
-        jst = timezone(timedelta(hours=9))
-        now_jst_iso = datetime.now(jst).isoformat()
-        if status == '投稿済':
-            # 投稿済みにする際は、投稿完了日時も記録する
-            conn.execute("UPDATE products SET status = ?, posted_at = ?, error_message = NULL WHERE id = ?", (status, now_jst_iso, product_id))
-        elif status == 'エラー':
-            conn.execute("UPDATE products SET status = ?, error_message = ? WHERE id = ?", (status, str(error_message), product_id))
-        else:
-            # エラーから復帰させる場合などはエラーメッセージをクリアする
-            conn.execute("UPDATE products SET status = ?, error_message = NULL WHERE id = ?", (status, product_id))
-        conn.commit()
+        with conn:
+            conn.execute(_UPDATE_PRODUCT_STATUS_SQL, (status, _now_jst_iso(), str(error_message), product_id))
         if status == 'エラー':
             logging.info(f"商品ID: {product_id} のステータスを「{status}」に更新しました。")
         else:
             logging.debug(f"商品ID: {product_id} のステータスを「{status}」に更新しました。")
     except sqlite3.Error as e:
         logging.error(f"商品ID: {product_id} のステータス更新中にエラーが発生しました: {e}")
-    finally:
-        conn.close()
 
-def update_status_for_multiple_products(product_ids: list[int], status: str):
-    """複数の商品のステータスを一括で更新する"""
+# 複数ID指定の一括更新・削除用のクエリ。IDリストはJSON配列1つとしてバインドし、件数によらずSQL文字列を固定にする
+# ステータスごとの違いは update_product_status と同じくCASE式で扱う
+_UPDATE_STATUS_BY_IDS_SQL = """
+    UPDATE products SET
+        status = ?1,
+        posted_at = CASE WHEN ?1 = '投稿済' THEN ?2 ELSE posted_at END,
+        error_message = CASE WHEN ?1 = 'エラー' THEN ?3 ELSE NULL END
+    WHERE id IN (SELECT value FROM json_each(?4))
+"""
+_BULK_RECOLLECT_BY_IDS_SQL = "UPDATE products SET status = '投稿準備完了', room_url = NULL, posted_at = NULL, error_message = NULL, priority = NULL WHERE id IN (SELECT value FROM json_each(?))"
+_DELETE_PRODUCTS_BY_IDS_SQL = "DELETE FROM products WHERE id IN (SELECT value FROM json_each(?))"
+
+def update_status_for_multiple_products(product_ids: list[int], status: str, error_message=None):
+    """
+    複数の商品のステータスを一括で更新する。
+    :param error_message: 「エラー」にする際に全商品へ記録するエラーメッセージ (省略時はクリアする)
+    """
     if not product_ids:
         return 0
     conn = get_db_connection()
-    try:
-        placeholders = ','.join('?' for _ in product_ids)
-        # JSTのタイムゾーンを定義
-        jst = timezone(timedelta(hours=9))
-        now_jst_iso = datetime.now(jst).isoformat()
-        if status == '投稿済':
-            query = f"UPDATE products SET status = ?, posted_at = ?, error_message = NULL WHERE id IN ({placeholders})"
-            params = [status, now_jst_iso] + product_ids
-        else:
-            query = f"UPDATE products SET status = ?, error_message = NULL WHERE id IN ({placeholders})"
-            params = [status] + product_ids
+    error_message = str(error_message) if error_message is not None else None
+    with conn:
         cursor = conn.cursor()
-        cursor.execute(query, params)
-        conn.commit()
-        logging.info(f"{len(product_ids)}件の商品のステータスを「{status}」に更新しました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+        cursor.execute(_UPDATE_STATUS_BY_IDS_SQL, (status, _now_jst_iso(), error_message, json.dumps(product_ids)))
+    logging.info(f"{len(product_ids)}件の商品のステータスを「{status}」に更新しました。")
+    return cursor.rowcount
 
 def recollect_product(product_id: int):
     """指定された商品を「投稿準備完了」ステータスに戻し、room_urlとposted_atをNULLにする"""
     conn = get_db_connection()
     try:
-        conn.execute("UPDATE products SET status = '投稿準備完了', room_url = NULL, posted_at = NULL, error_message = NULL, priority = NULL WHERE id = ?", (product_id,))
-        conn.commit()
+        with conn:
+            conn.execute("UPDATE products SET status = '投稿準備完了', room_url = NULL, posted_at = NULL, error_message = NULL, priority = NULL WHERE id = ?", (product_id,))
         logging.info(f"商品ID: {product_id} を「再コレ」として更新しました。")
         return True
     except sqlite3.Error as e:
         logging.error(f"商品ID: {product_id} の再コレ処理中にエラーが発生しました: {e}")
         return False
-    finally:
-        conn.close()
 
 def bulk_recollect_products(product_ids: list[int]):
     """複数の商品を一括で「投稿準備完了」ステータスに戻し、room_urlとposted_atをNULLにする"""
@@ -482,74 +798,73 @@ def bulk_recollect_products(product_ids: list[int]):
         return 0
     conn = get_db_connection()
     try:
-        placeholders = ','.join('?' for _ in product_ids)
-        query = f"UPDATE products SET status = '投稿準備完了', room_url = NULL, posted_at = NULL, error_message = NULL, priority = NULL WHERE id IN ({placeholders})"
-        cursor = conn.cursor()
-        cursor.execute(query, product_ids)
-        conn.commit()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute(_BULK_RECOLLECT_BY_IDS_SQL, (json.dumps(product_ids),))
         logging.debug(f"{len(product_ids)}件の商品を「再コレ」として一括更新しました。")
         return cursor.rowcount
     except sqlite3.Error as e:
         logging.error(f"商品の一括再コレ処理中にエラーが発生しました: {e}")
         return 0
-    finally:
-        conn.close()
 
 def update_product_priority(product_id: int, priority: int):
     """商品の優先度を更新する"""
     conn = get_db_connection()
-    conn.execute("UPDATE products SET priority = ? WHERE id = ?", (priority, product_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute("UPDATE products SET priority = ? WHERE id = ?", (priority, product_id))
     logging.debug(f"商品ID: {product_id} の優先度を {priority} に更新しました。")
 
+# get_all_keywords の読み込み結果。((mtime_ns, size), キーワードのタプル) を保持し、ファイルが変わったら読み直す
+_keywords_cache = None
+
 def get_all_keywords() -> list[dict]:
     """
     JSONファイルからすべてのキーワードを読み込み、辞書のリストとして返す。
+    ファイルの更新日時とサイズが前回と同じ場合は、解析済みの結果を使い回す。
     :return: [{'keyword': 'キーワード1'}, {'keyword': 'キーワード2'}, ...] の形式のリスト
     """
-    if not os.path.exists(KEYWORDS_FILE):
+    global _keywords_cache
+    try:
+        stat = os.stat(KEYWORDS_FILE)
+    except FileNotFoundError:
         logging.warning(f"キーワードファイルが見つかりません: {KEYWORDS_FILE}")
         return []
 
-    try:
-        with open(KEYWORDS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
+    file_key = (stat.st_mtime_ns, stat.st_size)
+    if _keywords_cache is None or _keywords_cache[0] != file_key:
+        try:
+            with open(KEYWORDS_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            logging.error(f"キーワードファイルの読み込みまたは解析に失敗しました: {e}")
+            return []
+
         keywords_a = data.get("keywords_a", [])
         keywords_b = data.get("keywords_b", [])
-        
-        all_keywords = keywords_a + keywords_b
-        
-        # 辞書のリスト形式に変換して返す
-        return [{"keyword": kw} for kw in all_keywords if kw]
-    except (IOError, json.JSONDecodeError) as e:
-        logging.error(f"キーワードファイルの読み込みまたは解析に失敗しました: {e}")
-        return []
+        _keywords_cache = (file_key, tuple(kw for kw in keywords_a + keywords_b if kw))
+
+    # 辞書のリスト形式に変換して返す (呼び出し側で変更されてもキャッシュに影響しないよう、毎回作る)
+    return [{"keyword": kw} for kw in _keywords_cache[1]]
+
+# update_post_url 用のクエリ。商品URLも差し替えるかどうかで2通りを固定文字列として持ち、ステートメントキャッシュを効かせる
+_UPDATE_POST_URL_SQL = "UPDATE products SET post_url = ?, shop_name = ?, post_url_updated_at = ?, status = 'URL取得済' WHERE id = ?"
+_UPDATE_POST_URL_WITH_URL_SQL = "UPDATE products SET post_url = ?, shop_name = ?, post_url_updated_at = ?, status = 'URL取得済', url = ? WHERE id = ?"
 
 def update_post_url(product_id, post_url, shop_name=None, new_main_url=None):
     """指定された商品の情報を更新し、ステータスを「URL取得済」に変更する"""
     conn = get_db_connection()
-    try:
-        jst = timezone(timedelta(hours=9))
-        now_jst_iso = datetime.now(jst).isoformat()
-
-        # 基本のUPDATE文
-        query = "UPDATE products SET post_url = ?, shop_name = ?, post_url_updated_at = ?, status = 'URL取得済'"
-        params = [post_url, shop_name, now_jst_iso]
+    now_jst_iso = _now_jst_iso()
 
-        if new_main_url:
-            query += ", url = ?"
-            params.append(new_main_url)
-        
-        query += " WHERE id = ?"
-        params.append(product_id)
+    if new_main_url:
+        query = _UPDATE_POST_URL_WITH_URL_SQL
+        params = (post_url, shop_name, now_jst_iso, new_main_url, product_id)
+    else:
+        query = _UPDATE_POST_URL_SQL
+        params = (post_url, shop_name, now_jst_iso, product_id)
 
-        conn.execute(query, tuple(params))
-        conn.commit()
-        logging.debug(f"商品ID: {product_id} の投稿URLを更新し、ステータスを「URL取得済」に変更しました。")
-    finally:
-        conn.close()
+    with conn:
+        conn.execute(query, params)
+    logging.debug(f"商品ID: {product_id} の投稿URLを更新し、ステータスを「URL取得済」に変更しました。")
 
 def update_product_post_url(product_id: int, post_url: str):
     """
@@ -558,17 +873,15 @@ def update_product_post_url(product_id: int, post_url: str):
     """
     conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        # post_urlカラムのみを更新する
-        cursor.execute("UPDATE products SET post_url = ? WHERE id = ?", (post_url, product_id))
-        conn.commit()
+        with conn:
+            cursor = conn.cursor()
+            # post_urlカラムのみを更新する
+            cursor.execute("UPDATE products SET post_url = ? WHERE id = ?", (post_url, product_id))
         logging.info(f"商品ID: {product_id} の投稿URLを更新しました。 URL: {post_url}")
         return cursor.rowcount
     except sqlite3.Error as e:
         logging.error(f"商品ID: {product_id} のpost_url更新中にエラー: {e}")
         return 0
-    finally:
-        conn.close()
 
 def update_product_room_url(product_id: int, room_url: str):
     """
@@ -576,22 +889,31 @@ def update_product_room_url(product_id: int, room_url: str):
     """
     conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE products SET room_url = ? WHERE id = ?", (room_url, product_id))
-        conn.commit()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE products SET room_url = ? WHERE id = ?", (room_url, product_id))
         logging.debug(f"商品ID: {product_id} のROOM URLを更新しました。 URL: {room_url}")
         return cursor.rowcount
     except sqlite3.Error as e:
         logging.error(f"商品ID: {product_id} のroom_url更新中にエラー: {e}")
         return 0
-    finally:
-        conn.close()
+
+# 部分一致の候補が「ちょうど1件」のときだけ更新する。候補が0件または2件以上なら
+# HAVING で行が消えてスカラーサブクエリが NULL になり、どの行にも一致しない。
+_UPDATE_ROOM_URL_BY_UNIQUE_LIKE_SQL = """
+    WITH matches AS (SELECT id FROM products WHERE url LIKE ? LIMIT 2)
+    UPDATE products SET room_url = ?
+    WHERE id = (SELECT MIN(id) FROM matches HAVING COUNT(*) = 1)
+    RETURNING id
+"""
+# 部分一致で更新しなかった場合に、候補が0件か複数件かを判別する (2件見つかった時点で走査を打ち切る)
+_COUNT_ROOM_URL_LIKE_CANDIDATES_SQL = "SELECT COUNT(*) FROM (SELECT 1 FROM products WHERE url LIKE ? LIMIT 2)"
 
 def update_room_url_by_rakuten_url(rakuten_url: str, room_url: str):
     """楽天市場のURLをキーに、ROOMの個別商品ページURLを更新する"""
     if not rakuten_url or not room_url:
         return
-    
+
     # パターン1: URLを正規化して完全一致で検索
     normalized_url = _normalize_rakuten_url(rakuten_url)
 
@@ -601,56 +923,65 @@ def update_room_url_by_rakuten_url(rakuten_url: str, room_url: str):
         encoded_pc_param = rakuten_url.split('?pc=')[1]
 
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
-        
+
         # まず正規化URLで検索・更新を試みる
         cursor.execute("UPDATE products SET room_url = ? WHERE url = ?", (room_url, normalized_url))
-        
+
         if cursor.rowcount > 0:
             logging.debug(f"  -> {cursor.rowcount}件のレコードのroom_urlを更新しました。(正規化URL: {normalized_url})")
-            conn.commit()
             return
 
         # パターン1で更新されなかった場合、パターン2（部分一致）を試す
         if encoded_pc_param:
             like_pattern = f"%{encoded_pc_param}%"
             logging.debug(f"正規化URLでの更新に失敗したため、部分一致検索を試みます。パターン: {like_pattern}")
-            
-            # 更新前に、対象が1件に絞れるか確認（意図しない複数更新を防ぐため）
-            cursor.execute("SELECT id FROM products WHERE url LIKE ?", (like_pattern,))
-            found_products = cursor.fetchall()
-
-            if len(found_products) == 1:
-                product_id_to_update = found_products[0]['id']
-                cursor.execute("UPDATE products SET room_url = ? WHERE id = ?", (room_url, product_id_to_update))
-                if cursor.rowcount > 0:
-                    logging.debug(f"  -> 1件のレコードのroom_urlを更新しました。(部分一致パターン)")
-            elif len(found_products) > 1:
-                logging.warning(f"  -> 部分一致で複数の更新対象が見つかったため、更新をスキップします。({len(found_products)}件)")
+
+            # 対象が1件に絞れる場合のみ更新する（意図しない複数更新を防ぐため）
+            cursor.execute(_UPDATE_ROOM_URL_BY_UNIQUE_LIKE_SQL, (like_pattern, room_url))
+            if cursor.fetchall():
+                logging.debug(f"  -> 1件のレコードのroom_urlを更新しました。(部分一致パターン)")
+                return
+            # 更新されなかった理由 (候補なし / 複数候補) をログで区別する
+            cursor.execute(_COUNT_ROOM_URL_LIKE_CANDIDATES_SQL, (like_pattern,))
+            if cursor.fetchone()[0] > 1:
+                logging.warning("  -> 部分一致で複数の更新対象が見つかったため、更新をスキップします。")
             else:
                 logging.warning(f"  -> room_urlの更新対象レコードが見つかりませんでした。(URL: {normalized_url})")
         else:
             logging.warning(f"  -> room_urlの更新対象レコードが見つかりませんでした。(URL: {normalized_url})")
-        
-        conn.commit()
-    finally:
-        conn.close()
+
+
+_UPDATE_AI_CAPTION_SQL = "UPDATE products SET ai_caption = ?, ai_caption_created_at = ?, status = '投稿準備完了' WHERE id = ?"
 
 def update_ai_caption(product_id: int, caption: str) -> int:
     """指定された商品のAI投稿文と更新日時を更新し、ステータスを「投稿準備完了」に変更する"""
     conn = get_db_connection()
-    try:
-        # JSTのタイムゾーンを定義
-        jst = timezone(timedelta(hours=9))
-        now_jst_iso = datetime.now(jst).isoformat()
+    now_jst_iso = _now_jst_iso()
+    with conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE products SET ai_caption = ?, ai_caption_created_at = ?, status = '投稿準備完了' WHERE id = ?", (caption, now_jst_iso, product_id))
-        conn.commit()
-        logging.debug(f"商品ID: {product_id} のAI投稿文を更新し、ステータスを「投稿準備完了」に変更しました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+        cursor.execute(_UPDATE_AI_CAPTION_SQL, (caption, now_jst_iso, product_id))
+    logging.debug(f"商品ID: {product_id} のAI投稿文を更新し、ステータスを「投稿準備完了」に変更しました。")
+    return cursor.rowcount
+
+def bulk_update_ai_captions(captions: list[tuple[int, str]]) -> int:
+    """
+    複数の商品のAI投稿文を1トランザクションで更新し、ステータスを「投稿準備完了」に変更する。
+    :param captions: (product_id, caption) のタプルのリスト
+    :return: 更新された行数
+    """
+    if not captions:
+        return 0
+    conn = get_db_connection()
+    now_jst_iso = _now_jst_iso()
+    with conn:
+        cursor = conn.executemany(_UPDATE_AI_CAPTION_SQL, ((caption, now_jst_iso, product_id) for product_id, caption in captions))
+    logging.debug(f"{cursor.rowcount}件の商品のAI投稿文を更新し、ステータスを「投稿準備完了」に変更しました。")
+    return cursor.rowcount
+
+# アフィリエイトURLのクエリから pc パラメータ (実際の商品URL) を取り出す
+_AFFILIATE_PC_PARAM_RE = re.compile(r"[?&]pc=([^&#]+)")
 
 def _normalize_rakuten_url(url: str) -> str:
     """
@@ -658,15 +989,11 @@ def _normalize_rakuten_url(url: str) -> str:
     それ以外のURLはそのまま返す。
     """
     if "hb.afl.rakuten.co.jp" in url:
-        try:
-            parsed_url = urlparse(url)
-            query_params = parse_qs(parsed_url.query)
-            pc_url = query_params.get('pc', [None])[0]
-            if pc_url:
-                # pc_url自体もクエリパラメータを持つ可能性があるので、それも除去
-                url = pc_url.split('?')[0]
-        except Exception:
-            pass # パースに失敗した場合は元のURLを返す
+        # URL全体をパースせず、pcパラメータだけを正規表現で取り出す
+        match = _AFFILIATE_PC_PARAM_RE.search(url)
+        if match:
+            # pc_url自体もクエリパラメータを持つ可能性があるので、それも除去
+            url = unquote_plus(match.group(1)).split('?')[0]
 
     # アフィリエイトリンク以外、またはpcパラメータの抽出後、
     # ? 以降のクエリパラメータを削除してURLを正規化する
@@ -691,40 +1018,43 @@ def add_recollection_product(name=None, url=None, image_url=None, shop_name=None
     unique_url = _normalize_rakuten_url(url)
 
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
 
         # 1. 前方一致で既存レコードを検索 (http/httpsの違いを吸収)
         # `https://` または `http://` を除いた部分で検索する
         url_part = unique_url.split("://", 1)[-1]
-        
+
         # DBに保存されているURLも `://` 以降の部分で比較する
         # これにより、DBにhttpで保存されていても、httpsで検索した際に見つけられる
-        # 前方一致検索も同時に行う
-        like_pattern = f"{url_part}%"
-        cursor.execute("""
-            SELECT id FROM products WHERE SUBSTR(url, INSTR(url, '://') + 3) LIKE ? LIMIT 1
-        """, (like_pattern,))
-        existing_product = cursor.fetchone()
-
+        # 前方一致は範囲検索 (url_part <= x < url_part + 最大コードポイント) で行い、式インデックス idx_products_url_without_scheme を使う
+        # (LIKE は式インデックスを使えず、URL中の '_' や '%' もワイルドカードとして扱ってしまう)
         # 2. 既存レコードがあればUPDATE、なければINSERT
-        if existing_product:
-            # 既存レコードを更新
-            product_id = existing_product['id']
-            logging.info(f"URLが前方一致で重複したため、既存の商品(ID: {product_id})を更新します。")
-            cursor.execute("""
-                UPDATE products SET
-                    url = ?,
-                    name = ?,
-                    image_url = ?,
-                    shop_name = ?,
-                    procurement_keyword = ?,
-                    status = '投稿準備完了',
-                    posted_at = NULL,
-                    error_message = NULL
-                WHERE id = ?
-            """, (unique_url, name, image_url, shop_name, procurement_keyword, product_id))
-            conn.commit()
+        # 検索と更新は1つのUPDATE文で行い、RETURNING で更新した商品のIDを受け取る
+        cursor.execute("""
+            UPDATE products SET
+                url = :url,
+                name = :name,
+                image_url = :image_url,
+                shop_name = :shop_name,
+                procurement_keyword = :procurement_keyword,
+                status = '投稿準備完了',
+                posted_at = NULL,
+                error_message = NULL
+            WHERE id = (
+                SELECT id FROM products
+                WHERE SUBSTR(url, INSTR(url, '://') + 3) >= :url_part AND SUBSTR(url, INSTR(url, '://') + 3) < :url_part_end
+                LIMIT 1
+            )
+            RETURNING id
+        """, {
+            'url': unique_url, 'name': name, 'image_url': image_url, 'shop_name': shop_name,
+            'procurement_keyword': procurement_keyword, 'url_part': url_part, 'url_part_end': url_part + "\U0010ffff",
+        })
+        updated_product = cursor.fetchone()
+
+        if updated_product:
+            logging.info(f"URLが前方一致で重複したため、既存の商品(ID: {updated_product['id']})を更新しました。")
             return False # 更新なので 'was_inserted' は False
         else:
             # 新規レコードを挿入
@@ -732,11 +1062,8 @@ def add_recollection_product(name=None, url=None, image_url=None, shop_name=None
             cursor.execute("""
                 INSERT INTO products (name, url, image_url, shop_name, procurement_keyword, status, created_at)
                 VALUES (?, ?, ?, ?, ?, '生情報取得', ?)
-            """, (name, unique_url, image_url, shop_name, procurement_keyword, datetime.now(timezone(timedelta(hours=9))).isoformat()))
-            conn.commit()
+            """, (name, unique_url, image_url, shop_name, procurement_keyword, _now_jst_iso()))
             return True # 新規挿入なので True
-    finally:
-        conn.close()
 
 def add_product_if_not_exists(name=None, url=None, image_url=None, procurement_keyword=None):
     """同じURLの商品が存在しない場合のみ、新しい商品をDBに追加する。調達キーワードも保存する。"""
@@ -744,23 +1071,20 @@ def add_product_if_not_exists(name=None, url=None, image_url=None, procurement_k
         logging.warning("商品名またはURLが不足しているため、DBに追加できません。")
         return False
 
-    # JSTのタイムゾーンを定義
-    jst = timezone(timedelta(hours=9))
-    # JSTの現在時刻をISO 8601形式の文字列で取得
-    created_at_jst = datetime.now(jst).isoformat()
+    created_at_jst = _now_jst_iso()
 
     conn = get_db_connection()
-    try:
+    # URLが重複する場合は何もせず、RETURNING の結果の有無で追加できたかを判定する (例外を使わない)
+    with conn:
         # created_atも明示的にJSTで指定する
-        conn.execute("INSERT INTO products (name, url, image_url, procurement_keyword, status, created_at) VALUES (?, ?, ?, ?, '生情報取得', ?)",
-                       (name, url, image_url, procurement_keyword, created_at_jst))
-        conn.commit()
-        return True # 新規追加成功
-    except sqlite3.IntegrityError:
+        inserted = conn.execute(
+            "INSERT INTO products (name, url, image_url, procurement_keyword, status, created_at) VALUES (?, ?, ?, ?, '生情報取得', ?) "
+            "ON CONFLICT(url) DO NOTHING RETURNING id",
+            (name, url, image_url, procurement_keyword, created_at_jst)
+        ).fetchone() is not None
+    if not inserted:
         logging.debug(f"URLが重複しているため、商品は追加されませんでした: {url}")
-        return False  # 既に存在する
-    finally:
-        conn.close()
+    return inserted
 
 def add_raw_product(name: str, url: str, image_url: str | None):
     """
@@ -775,42 +1099,56 @@ def add_raw_product(name: str, url: str, image_url: str | None):
         logging.warning("商品名またはURLが不足しているため、DBに追加できません。")
         return False
 
-    jst = timezone(timedelta(hours=9))
-    created_at_jst = datetime.now(jst).isoformat()
+    created_at_jst = _now_jst_iso()
     conn = get_db_connection()
-    try:
-        conn.execute("INSERT INTO products (name, url, image_url, status, created_at) VALUES (?, ?, ?, '生情報取得', ?)", (name, url, image_url, created_at_jst))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False # URLのUNIQUE制約により重複
-    finally:
-        conn.close()
+    with conn:
+        # URLのUNIQUE制約により重複する場合は何もしない (RETURNING が空になる)
+        return conn.execute(
+            "INSERT INTO products (name, url, image_url, status, created_at) VALUES (?, ?, ?, '生情報取得', ?) "
+            "ON CONFLICT(url) DO NOTHING RETURNING id",
+            (name, url, image_url, created_at_jst)
+        ).fetchone() is not None
+
+_PRODUCT_EXISTS_BY_URL_SQL = "SELECT 1 FROM products WHERE url = ? LIMIT 1"
+# URLリストはJSON配列1つとしてバインドし、件数によらずSQL文字列を固定にする
+_EXISTING_PRODUCT_URLS_SQL = "SELECT url FROM products WHERE url IN (SELECT value FROM json_each(?))"
 
 def product_exists_by_url(url: str) -> bool:
     """指定されたURLの商品がデータベースに存在するかどうかをチェックする。"""
     if not url:
         return False
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1 FROM products WHERE url = ? LIMIT 1", (url,))
-        return cursor.fetchone() is not None
-    finally:
-        conn.close()
+    return conn.execute(_PRODUCT_EXISTS_BY_URL_SQL, (url,)).fetchone() is not None
+
+def get_existing_product_urls(urls: list[str]) -> set[str]:
+    """
+    指定されたURLのうち、データベースに既に存在するものを集合で返す。
+    複数URLの重複チェックを1回のクエリで行うために使う。
+    """
+    urls = [url for url in urls if url]
+    if not urls:
+        return set()
+    conn = get_db_connection()
+    return {row['url'] for row in conn.execute(_EXISTING_PRODUCT_URLS_SQL, (json.dumps(urls),))}
 
 def product_exists_by_post_url(post_url: str) -> bool:
     """指定されたpost_urlを持つ商品がデータベースに存在するかどうかをチェックする。"""
     if not post_url:
         return False
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        # post_urlがNULLでないレコードも考慮
-        cursor.execute("SELECT 1 FROM products WHERE post_url = ? AND post_url IS NOT NULL LIMIT 1", (post_url,))
-        return cursor.fetchone() is not None
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    # post_urlがNULLでないレコードも考慮
+    cursor.execute("SELECT 1 FROM products WHERE post_url = ? AND post_url IS NOT NULL LIMIT 1", (post_url,))
+    return cursor.fetchone() is not None
+
+# import_products で1トランザクションにまとめて挿入する件数
+IMPORT_CHUNK_SIZE = 10000
+# URLが重複する行だけを無視する (INSERT OR IGNORE と違い、他の制約違反は握りつぶさない)
+_IMPORT_PRODUCT_SQL = """
+    INSERT INTO products (name, url, image_url, procurement_keyword, status, created_at)
+    VALUES (?, ?, ?, ?, '生情報取得', ?)
+    ON CONFLICT(url) DO NOTHING
+"""
 
 def import_products(products_data: list[dict]):
     """
@@ -820,22 +1158,23 @@ def import_products(products_data: list[dict]):
     if not products_data:
         return 0
 
-    jst = timezone(timedelta(hours=9))
-    created_at_jst = datetime.now(jst).isoformat()
+    created_at_jst = _now_jst_iso()
 
-    # executemany用に、辞書のリストをタプルのリストに変換
-    records_to_insert = [
+    # executemany用に、辞書をタプルに変換するジェネレータ (全件のリストは作らない)
+    records_to_insert = (
         (p.get('name'), p.get('url'), p.get('image_url'), p.get('procurement_keyword'), created_at_jst) for p in products_data if p.get('name') and p.get('url')
-    ]
+    )
 
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.executemany("INSERT OR IGNORE INTO products (name, url, image_url, procurement_keyword, status, created_at) VALUES (?, ?, ?, ?, '生情報取得', ?)", records_to_insert)
-        conn.commit()
-        return cursor.rowcount # 実際に挿入された行数を返す
-    finally:
-        conn.close()
+    inserted_count = 0
+    # IMPORT_CHUNK_SIZE 件ずつ、チャンクごとに1トランザクションで挿入する
+    while chunk := list(islice(records_to_insert, IMPORT_CHUNK_SIZE)):
+        # BEGIN IMMEDIATE で書き込みロックを先に確保し、途中で他の書き込みと競合して失敗しないようにする
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            cursor = conn.executemany(_IMPORT_PRODUCT_SQL, chunk)
+        inserted_count += cursor.rowcount
+    return inserted_count # 実際に挿入された行数を返す
 
 def delete_all_products():
     """
@@ -844,41 +1183,50 @@ def delete_all_products():
     """
     conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM products")
+        # 削除トリガーがあると SQLite の全件削除の最適化 (テーブルをページ単位で一括解放) が使えず、
+        # 1行ずつ削除してインデックスとWALに書き込むことになる。
+        # 同じトランザクション内でトリガーを外して全件削除し、件数テーブルを空にしてからトリガーを戻す
+        # (sqlite3モジュールはDDLの前に自動でBEGINしないため明示する)
+        conn.execute("BEGIN")
+        conn.execute("DROP TRIGGER IF EXISTS trg_products_status_count_delete")
+        deleted_count = conn.execute("DELETE FROM products").rowcount
+        conn.execute("DELETE FROM product_status_counts")
+        conn.execute(_PRODUCT_STATUS_COUNT_DELETE_TRIGGER_SQL)
         conn.commit()
-        logging.info("すべての商品レコードが削除されました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    logging.info("すべての商品レコードが削除されました。")
+    return deleted_count
 
 def delete_product(product_id: int):
     """指定されたIDの商品を削除する"""
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-        conn.commit()
-        logging.info(f"商品ID: {product_id} を削除しました。")
-        return cursor.rowcount > 0
-    finally:
-        conn.close()
+    logging.info(f"商品ID: {product_id} を削除しました。")
+    return cursor.rowcount > 0
 
 def delete_multiple_products(product_ids: list[int]):
     """指定されたIDの複数の商品を一括で削除する"""
     if not product_ids:
         return 0
     conn = get_db_connection()
-    try:
-        placeholders = ','.join('?' for _ in product_ids)
-        query = f"DELETE FROM products WHERE id IN ({placeholders})"
+    with conn:
         cursor = conn.cursor()
-        cursor.execute(query, product_ids)
-        conn.commit()
-        logging.debug(f"{len(product_ids)}件の商品を削除しました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+        cursor.execute(_DELETE_PRODUCTS_BY_IDS_SQL, (json.dumps(product_ids),))
+    logging.debug(f"{len(product_ids)}件の商品を削除しました。")
+    return cursor.rowcount
+
+# update_product_order 用のクエリ。IDのリスト (JSON配列) の位置 (key) から priority を計算し、1文で更新する
+# リストの先頭が高い優先度 (?2 = 件数) になるよう降順で設定する。
+# 並べ替えで位置が変わらなかった商品は priority も変わらないため、書き込み自体を省く
+_UPDATE_PRODUCT_ORDER_SQL = """
+    UPDATE products SET priority = ?2 - ids.key
+    FROM json_each(?1) AS ids
+    WHERE products.id = ids.value AND products.priority IS NOT ?2 - ids.key
+"""
 
 def update_product_order(product_ids: list[int]):
     """商品のリスト順に基づいてpriorityを更新する"""
@@ -886,16 +1234,23 @@ def update_product_order(product_ids: list[int]):
         return
 
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        # リストの先頭が高い優先度になるように、priorityを降順で設定
-        max_priority = len(product_ids)
-        for i, product_id in enumerate(product_ids):
-            cursor.execute("UPDATE products SET priority = ? WHERE id = ?", (max_priority - i, product_id))
-        conn.commit()
-        logging.debug(f"{len(product_ids)}件の商品の順序を更新しました。")
-    finally:
-        conn.close()
+    with conn:
+        conn.execute(_UPDATE_PRODUCT_ORDER_SQL, (json.dumps(product_ids), len(product_ids)))
+    logging.debug(f"{len(product_ids)}件の商品の順序を更新しました。")
+
+# bulk_update_products_from_data 用のSQL。更新内容 (post_url/ai_caption の有無) ごとに固定のSQLを用意する
+_BULK_UPDATE_PRODUCT_BASE_SQL = "UPDATE products SET post_url = ?, ai_caption = ?, error_message = NULL"
+# post_url と ai_caption が両方ある: 投稿準備完了
+_BULK_UPDATE_PRODUCT_READY_SQL = (
+    f"{_BULK_UPDATE_PRODUCT_BASE_SQL}, status = '投稿準備完了', "
+    "post_url_updated_at = COALESCE(post_url_updated_at, ?), ai_caption_created_at = COALESCE(ai_caption_created_at, ?) WHERE id = ?"
+)
+# post_url のみ: URL取得済
+_BULK_UPDATE_PRODUCT_URL_SQL = (
+    f"{_BULK_UPDATE_PRODUCT_BASE_SQL}, status = 'URL取得済', post_url_updated_at = COALESCE(post_url_updated_at, ?) WHERE id = ?"
+)
+# それ以外: ステータスは変更しない
+_BULK_UPDATE_PRODUCT_PLAIN_SQL = f"{_BULK_UPDATE_PRODUCT_BASE_SQL} WHERE id = ?"
 
 def bulk_update_products_from_data(products_data: list[dict]):
     """
@@ -905,49 +1260,43 @@ def bulk_update_products_from_data(products_data: list[dict]):
     if not products_data:
         return 0, 0
 
-    conn = get_db_connection()
-    updated_count = 0
     failed_count = 0
-    jst = timezone(timedelta(hours=9))
+    now_jst_iso = _now_jst_iso()
+
+    # 更新内容ごとにパラメータを振り分け、SQLごとに executemany でまとめて実行する
+    ready_params, url_params, plain_params = [], [], []
+    for product_data in products_data:
+        product_id = product_data.get('id')
+        if not product_id:
+            failed_count += 1
+            continue
+
+        # 更新対象のフィールドを抽出
+        post_url = product_data.get('post_url')
+        ai_caption = product_data.get('ai_caption')
+
+        if post_url and ai_caption:
+            ready_params.append((post_url, ai_caption, now_jst_iso, now_jst_iso, product_id))
+        elif post_url:
+            url_params.append((post_url, ai_caption, now_jst_iso, product_id))
+        else:
+            plain_params.append((post_url, ai_caption, product_id))
 
+    conn = get_db_connection()
+    updated_count = 0
     try:
         with conn:  # トランザクションを開始
-            for product_data in products_data:
-                product_id = product_data.get('id')
-                if not product_id:
-                    failed_count += 1
-                    continue
-
-                # 更新対象のフィールドを抽出
-                post_url = product_data.get('post_url')
-                ai_caption = product_data.get('ai_caption')
-
-                # ステータスとタイムスタンプのロジック
-                now_jst_iso = datetime.now(jst).isoformat()
-                status_update_sql = ""
-                params = []
-
-                if post_url and ai_caption:
-                    status_update_sql = ", status = '投稿準備完了', post_url_updated_at = COALESCE(post_url_updated_at, ?), ai_caption_created_at = COALESCE(ai_caption_created_at, ?)"
-                    params.extend([now_jst_iso, now_jst_iso])
-                elif post_url:
-                    status_update_sql = ", status = 'URL取得済', post_url_updated_at = COALESCE(post_url_updated_at, ?)"
-                    params.append(now_jst_iso)
-
-                # 基本のUPDATE文
-                query = f"UPDATE products SET post_url = ?, ai_caption = ?, error_message = NULL {status_update_sql} WHERE id = ?"
-                final_params = [post_url, ai_caption] + params + [product_id]
-
-                cursor = conn.cursor()
-                cursor.execute(query, final_params)
-                if cursor.rowcount > 0:
-                    updated_count += 1
+            for query, params_list in (
+                (_BULK_UPDATE_PRODUCT_READY_SQL, ready_params),
+                (_BULK_UPDATE_PRODUCT_URL_SQL, url_params),
+                (_BULK_UPDATE_PRODUCT_PLAIN_SQL, plain_params),
+            ):
+                if params_list:
+                    updated_count += conn.executemany(query, params_list).rowcount
 
     except sqlite3.Error as e:
         logging.error(f"商品の一括データ更新中にエラーが発生しました: {e}")
         raise  # エラーを呼び出し元に伝播させる
-    finally:
-        conn.close()
 
     return updated_count, failed_count
 
@@ -970,19 +1319,16 @@ def bulk_insert_my_post_comments(comments_data: list[dict]) -> int | None:
     placeholders = ", ".join(["?"] * len(columns))
 
     # 挿入用データを作成（created_atを追加）
-    created_at_jst = datetime.now(timezone(timedelta(hours=9))).isoformat()
+    created_at_jst = _now_jst_iso()
     data_to_insert = [tuple(d.get(col, created_at_jst) for col in columns) for d in comments_data]
 
     sql = f"INSERT OR IGNORE INTO my_post_comments ({col_str}) VALUES ({placeholders})"
 
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
         cursor.executemany(sql, data_to_insert)
-        conn.commit()
-        return cursor.rowcount
-    finally:
-        conn.close()
+    return cursor.rowcount
 
 def get_latest_comment_timestamps_by_post() -> dict[str, str]:
     """
@@ -990,16 +1336,13 @@ def get_latest_comment_timestamps_by_post() -> dict[str, str]:
     :return: { 'post_detail_url': 'latest_post_timestamp', ... } という形式の辞書
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT post_detail_url, MAX(post_timestamp) as latest_timestamp
-            FROM my_post_comments
-            GROUP BY post_detail_url
-        """)
-        return {row['post_detail_url']: row['latest_timestamp'] for row in cursor.fetchall()}
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT post_detail_url, MAX(post_timestamp) as latest_timestamp
+        FROM my_post_comments
+        GROUP BY post_detail_url
+    """)
+    return {row['post_detail_url']: row['latest_timestamp'] for row in cursor.fetchall()}
 
 def get_latest_comment_details_by_post() -> dict[str, dict]:
     """
@@ -1008,23 +1351,22 @@ def get_latest_comment_details_by_post() -> dict[str, dict]:
     :return: { 'post_detail_url': {'post_timestamp': '...', 'user_page_url': '...', 'comment_text': '...'}, ... }
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        # 各投稿ごとに最新のタイムスタンプを持つレコードのIDを取得し、そのレコードの全情報を取得する
-        # (post_detail_url, post_timestamp) の組み合わせで最新の1件を特定する
-        cursor.execute("""
-            SELECT c.*
-            FROM my_post_comments c
-            INNER JOIN (
-                SELECT post_detail_url, MAX(post_timestamp) as max_ts
-                FROM my_post_comments
-                GROUP BY post_detail_url
-            ) AS latest ON c.post_detail_url = latest.post_detail_url AND c.post_timestamp = latest.max_ts
-        """)
-        # 辞書に変換して返す
-        return {row['post_detail_url']: dict(row) for row in cursor.fetchall()}
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    # 各投稿ごとに最新のタイムスタンプを持つレコードのIDを取得し、そのレコードの全情報を取得する
+    # (post_detail_url, post_timestamp) の組み合わせで最新の1件を特定する
+    # 呼び出し側 (重複収集の判定) が使うカラムだけを取得する
+    cursor.execute("""
+        SELECT c.post_detail_url, c.post_timestamp, c.user_page_url, c.comment_text
+        FROM my_post_comments c
+        INNER JOIN (
+            SELECT post_detail_url, MAX(post_timestamp) as max_ts
+            FROM my_post_comments
+            GROUP BY post_detail_url
+        ) AS latest ON c.post_detail_url = latest.post_detail_url AND c.post_timestamp = latest.max_ts
+    """)
+    # 辞書に変換して返す
+    return {row['post_detail_url']: row for row in _rows_as_dicts(cursor)}
 
 def get_unreplied_comments(limit: int = 20) -> list[dict]:
     """
@@ -1034,17 +1376,15 @@ def get_unreplied_comments(limit: int = 20) -> list[dict]:
     :return: コメントデータの辞書のリスト
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM my_post_comments
-            WHERE reply_generated_at IS NULL
-            ORDER BY post_timestamp DESC
-            LIMIT ?
-        """, (limit,))
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute("""
+        SELECT * FROM my_post_comments
+        WHERE reply_generated_at IS NULL
+        ORDER BY post_timestamp DESC
+        LIMIT ?
+    """, (limit,))
+    return _rows_as_dicts(cursor)
 
 def get_post_urls_with_unreplied_comments() -> list[str]:
     """
@@ -1052,18 +1392,15 @@ def get_post_urls_with_unreplied_comments() -> list[str]:
     最新の未返信コメント日時が新しい順に取得する。
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT post_detail_url
-            FROM my_post_comments
-            WHERE reply_generated_at IS NULL
-            GROUP BY post_detail_url
-            ORDER BY MAX(post_timestamp) DESC
-        """)
-        return [row['post_detail_url'] for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT post_detail_url
+        FROM my_post_comments
+        WHERE reply_generated_at IS NULL
+        GROUP BY post_detail_url
+        ORDER BY MAX(post_timestamp) DESC
+    """)
+    return [row['post_detail_url'] for row in cursor.fetchall()]
 
 def get_unreplied_comments_for_post(post_detail_url: str) -> list[dict]:
     """指定された投稿URLについて、返信がまだ生成されていないコメントを取得する。"""
@@ -1071,9 +1408,31 @@ def get_unreplied_comments_for_post(post_detail_url: str) -> list[dict]:
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM my_post_comments WHERE post_detail_url = ? AND reply_generated_at IS NULL ORDER BY post_timestamp DESC", (post_detail_url,))
     comments = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return comments
 
+def get_unreplied_comments_grouped_by_post() -> dict[str, list[dict]]:
+    """
+    返信がまだ生成されていないコメントを、投稿URLごとにまとめて1回のクエリで取得する。
+    投稿は最新の未返信コメント日時が新しい順、各投稿のコメントは新しい順に並ぶ
+    (get_post_urls_with_unreplied_comments と get_unreplied_comments_for_post を組み合わせた結果と同じ順序)。
+    :return: { 'post_detail_url': [コメントの辞書, ...], ... }
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    # 返信生成に使うカラムだけを取得する
+    cursor.execute("""
+        SELECT id, post_detail_url, user_name, comment_text, post_timestamp
+        FROM my_post_comments
+        WHERE reply_generated_at IS NULL
+        ORDER BY post_timestamp DESC
+    """)
+    # 新しい順に走査するため、各投稿が最初に現れた位置がその投稿の最新コメントになり、辞書の挿入順がそのまま投稿の並び順になる
+    comments_by_post = {}
+    for comment in _rows_as_dicts(cursor):
+        comments_by_post.setdefault(comment['post_detail_url'], []).append(comment)
+    return comments_by_post
+
 def bulk_update_comment_replies(replies: list[dict]):
     """
     AIが生成した返信テキストと関連情報をDBに一括で更新する。comment_idをキーに更新する。
@@ -1082,7 +1441,7 @@ def bulk_update_comment_replies(replies: list[dict]):
     if not replies:
         return 0
 
-    now_jst_iso = datetime.now(timezone(timedelta(hours=9))).isoformat()
+    now_jst_iso = _now_jst_iso()
     
     # 更新用データのリストを作成
     update_data = []
@@ -1093,17 +1452,14 @@ def bulk_update_comment_replies(replies: list[dict]):
             update_data.append((reply_text, now_jst_iso, comment_id))
 
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
         # comment_id を使って正確に更新する
         cursor.executemany("""
             UPDATE my_post_comments SET reply_text = ?, reply_generated_at = ?
             WHERE id = ? AND reply_generated_at IS NULL
         """, update_data)
-        conn.commit()
-        return cursor.rowcount
-    finally:
-        conn.close()
+    return cursor.rowcount
 
 def get_generated_replies(hours_ago: int = 24) -> list[dict]:
     """
@@ -1112,20 +1468,29 @@ def get_generated_replies(hours_ago: int = 24) -> list[dict]:
     :param hours_ago: 何時間前までに生成されたコメントを対象とするか
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        threshold_time = (datetime.now(timezone.utc) - timedelta(hours=hours_ago)).isoformat()
-
-        cursor.execute("""
-            SELECT * FROM my_post_comments
-            WHERE reply_text IS NOT NULL 
-              AND reply_text != '[SKIPPED]' AND reply_posted_at IS NULL
-              AND reply_generated_at >= ?
-            ORDER BY reply_generated_at, post_timestamp DESC
-        """, (threshold_time,))
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    # reply_generated_at はJSTのISO形式文字列で保存されているため、しきい値もJSTのISO形式で比較する
+    threshold_time = (datetime.now(JST) - timedelta(hours=hours_ago)).isoformat()
+
+    # 返信確認画面 (/api/generated-replies) が使うカラムだけを取得する
+    cursor.execute("""
+        SELECT id, post_detail_url, user_name, user_page_url, comment_text, post_timestamp, reply_text, reply_generated_at
+        FROM my_post_comments
+        WHERE reply_text IS NOT NULL 
+          AND reply_text != '[SKIPPED]' AND reply_posted_at IS NULL
+          AND reply_generated_at >= ?
+        ORDER BY reply_generated_at, post_timestamp DESC
+    """, (threshold_time,))
+    return _rows_as_dicts(cursor)
+
+# update_reply_text 用のクエリ。代表コメントの (post_detail_url, reply_text) をサブクエリで取り、同じグループを1文で更新する
+# サブクエリは相関しないため、更新前の値で1度だけ評価される
+_UPDATE_REPLY_TEXT_GROUP_SQL = """
+    UPDATE my_post_comments
+    SET reply_text = ?
+    WHERE (post_detail_url, reply_text) = (SELECT post_detail_url, reply_text FROM my_post_comments WHERE id = ?)
+"""
 
 def update_reply_text(comment_id: int, new_text: str):
     """
@@ -1133,48 +1498,28 @@ def update_reply_text(comment_id: int, new_text: str):
     グループは post_detail_url と元の reply_text によって定義される。
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-
-        # 1. 代表コメントIDから、グループを特定するための情報を取得
-        cursor.execute("SELECT post_detail_url, reply_text FROM my_post_comments WHERE id = ?", (comment_id,))
-        representative_comment = cursor.fetchone()
-
-        if not representative_comment:
-            logging.warning(f"コメント(ID: {comment_id})が見つからないため、更新できませんでした。")
-            return
-
-        original_post_url = representative_comment['post_detail_url']
-        original_reply_text = representative_comment['reply_text']
+    with conn:
+        cursor = conn.execute(_UPDATE_REPLY_TEXT_GROUP_SQL, (new_text, comment_id))
 
-        # 2. 同じグループに属するすべてのコメントの返信テキストを一括で更新
-        cursor.execute("""
-            UPDATE my_post_comments 
-            SET reply_text = ? 
-            WHERE post_detail_url = ? AND reply_text = ?
-        """, (new_text, original_post_url, original_reply_text))
-
-        conn.commit()
-        updated_count = cursor.rowcount
-        logging.info(f"コメントグループ（代表ID: {comment_id}）の返信テキストを更新しました。対象件数: {updated_count}件")
+    updated_count = cursor.rowcount
+    if updated_count == 0:
+        # IDの行が存在しない場合のほか、reply_text が NULL で行値の比較が一致しない場合もここに来る
+        logging.warning(f"コメント(ID: {comment_id})のグループに更新条件と一致する行がなかったため、更新しませんでした。")
+        return
+    logging.info(f"コメントグループ（代表ID: {comment_id}）の返信テキストを更新しました。対象件数: {updated_count}件")
 
-    finally:
-        conn.close()
 
 def ignore_reply(comment_id: int):
     """
     指定されたコメントIDの返信を無視する（reply_textにスキップマーカーを設定し、処理済みとする）。
     """
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
         # スキップした日時も記録することで、再生成の対象から外す
-        now_jst_iso = datetime.now(timezone(timedelta(hours=9))).isoformat()
+        now_jst_iso = _now_jst_iso()
         cursor.execute("UPDATE my_post_comments SET reply_text = '[SKIPPED]', reply_generated_at = ? WHERE id = ?", (now_jst_iso, comment_id,))
-        conn.commit()
-        logging.debug(f"コメント(ID: {comment_id})を返信対象から除外しました。")
-    finally:
-        conn.close()
+    logging.debug(f"コメント(ID: {comment_id})を返信対象から除外しました。")
 
 def mark_replies_as_posted(comment_ids: list[int]):
     """
@@ -1185,17 +1530,14 @@ def mark_replies_as_posted(comment_ids: list[int]):
         return 0
     
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
-        now_jst_iso = datetime.now(timezone(timedelta(hours=9))).isoformat()
-        placeholders = ','.join('?' for _ in comment_ids)
-        query = f"UPDATE my_post_comments SET reply_posted_at = ? WHERE id IN ({placeholders})"
-        cursor.execute(query, [now_jst_iso] + comment_ids)
-        conn.commit()
-        logging.debug(f"{cursor.rowcount}件のコメントを「投稿済み」として日時を更新しました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+        now_jst_iso = _now_jst_iso()
+        # IDリストはJSON配列1つとしてバインドし、件数によらずSQL文字列を固定にする
+        query = "UPDATE my_post_comments SET reply_posted_at = ? WHERE id IN (SELECT value FROM json_each(?))"
+        cursor.execute(query, (now_jst_iso, json.dumps(comment_ids)))
+    logging.debug(f"{cursor.rowcount}件のコメントを「投稿済み」として日時を更新しました。")
+    return cursor.rowcount
 
 def get_commenting_users_summary(limit: int = 50) -> list[dict]:
     """
@@ -1203,39 +1545,42 @@ def get_commenting_users_summary(limit: int = 50) -> list[dict]:
     最新コメント日時が新しい順にソートする。
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            WITH RankedUsers AS (
-                SELECT
-                    user_name,
-                    user_page_url,
-                    user_image_url,
-                    post_timestamp,
-                    like_back_count,
-                    last_like_back_at,
-                    ROW_NUMBER() OVER(PARTITION BY user_page_url ORDER BY post_timestamp DESC) as rn
-                FROM my_post_comments
-                WHERE user_page_url IS NOT NULL AND user_page_url != ''
-            )
+    cursor = conn.cursor()
+    # ユーザーごとの集計を GROUP BY 1回で行い、LIMIT で絞った後のユーザーについてだけ、
+    # 最新コメントの行 (名前・画像の取得元) を (user_page_url, post_timestamp) のインデックスで1件引く
+    cursor.execute("""
+        WITH user_stats AS (
             SELECT
-                (SELECT user_name FROM RankedUsers WHERE user_page_url = ru.user_page_url AND rn = 1) as user_name,
-                ru.user_page_url,
-                ru.user_page_url as user_id,
-                (SELECT user_image_url FROM RankedUsers WHERE user_page_url = ru.user_page_url AND rn = 1) as user_image_url,
-                COUNT(ru.user_page_url) as total_comments,
-                MAX(ru.post_timestamp) as latest_comment_timestamp,
-                MAX(ru.like_back_count) as like_back_count,
-                MAX(ru.last_like_back_at) as last_like_back_at
-            FROM my_post_comments ru
-            WHERE ru.user_page_url IS NOT NULL AND ru.user_page_url != ''
-            GROUP BY ru.user_page_url
+                user_page_url,
+                COUNT(*) as total_comments,
+                MAX(post_timestamp) as latest_comment_timestamp,
+                MAX(like_back_count) as like_back_count,
+                MAX(last_like_back_at) as last_like_back_at
+            FROM my_post_comments
+            WHERE user_page_url IS NOT NULL AND user_page_url != ''
+            GROUP BY user_page_url
             ORDER BY latest_comment_timestamp DESC
             LIMIT ?
-        """, (limit,))
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+        )
+        SELECT
+            latest.user_name,
+            s.user_page_url,
+            s.user_page_url as user_id,
+            latest.user_image_url,
+            s.total_comments,
+            s.latest_comment_timestamp,
+            s.like_back_count,
+            s.last_like_back_at
+        FROM user_stats s
+        JOIN my_post_comments latest ON latest.id = (
+            SELECT id FROM my_post_comments
+            WHERE user_page_url = s.user_page_url
+            ORDER BY post_timestamp DESC
+            LIMIT 1
+        )
+        ORDER BY s.latest_comment_timestamp DESC
+    """, (limit,))
+    return [dict(row) for row in cursor.fetchall()]
 
 def get_user_details_for_like_back(user_page_urls: list[str]) -> list[dict]:
     """
@@ -1248,19 +1593,25 @@ def get_user_details_for_like_back(user_page_urls: list[str]) -> list[dict]:
         return []
     
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        placeholders = ','.join('?' for _ in user_page_urls)
-        # my_post_commentsテーブルから最新の情報を取得する
-        # user_idとしてuser_page_urlをエイリアスで設定し、タスク側との互換性を保つ
-        query = f"""
-            SELECT DISTINCT user_name, user_page_url, user_page_url as user_id
-            FROM my_post_comments WHERE user_page_url IN ({placeholders})
-        """
-        cursor.execute(query, user_page_urls)
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    # my_post_commentsテーブルから最新の情報を取得する
+    # user_idとしてuser_page_urlをエイリアスで設定し、タスク側との互換性を保つ
+    # URLリストはJSON配列1つとしてバインドし、件数によらずSQL文字列を固定にする
+    query = """
+        SELECT DISTINCT user_name, user_page_url, user_page_url as user_id
+        FROM my_post_comments WHERE user_page_url IN (SELECT value FROM json_each(?))
+    """
+    cursor.execute(query, (json.dumps(user_page_urls),))
+    return [dict(row) for row in cursor.fetchall()]
+
+# update_like_back_status 用のクエリ。現在の累計 (ユーザーの全レコード中の最大値) に今回のいいね数を足し、
+# 該当ユーザーの全レコードへ1文で書き込む。サブクエリは相関しないため、更新前の値で1度だけ評価される
+_UPDATE_LIKE_BACK_STATUS_SQL = """
+    UPDATE my_post_comments
+    SET like_back_count = COALESCE((SELECT MAX(like_back_count) FROM my_post_comments WHERE user_page_url = ?1), 0) + ?2,
+        last_like_back_at = ?3
+    WHERE user_page_url = ?1
+"""
 
 def update_like_back_status(user_page_url: str, like_count: int):
     """
@@ -1270,28 +1621,8 @@ def update_like_back_status(user_page_url: str, like_count: int):
     :param like_count: 今回実行したいいね数
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        
-        # 1. 現在の累計いいね数を取得
-        cursor.execute("SELECT MAX(like_back_count) FROM my_post_comments WHERE user_page_url = ?", (user_page_url,))
-        current_total = cursor.fetchone()[0]
-        if current_total is None:
-            current_total = 0
-            
-        # 2. 新しい累計数を計算
-        new_total = current_total + like_count
-        
-        # 3. 最終実行日時と新しい累計数で、該当ユーザーの全レコードを更新
-        now_jst_iso = datetime.now(timezone(timedelta(hours=9))).isoformat()
-        cursor.execute("""
-            UPDATE my_post_comments
-            SET like_back_count = ?, last_like_back_at = ?
-            WHERE user_page_url = ?
-        """, (new_total, now_jst_iso, user_page_url))
-        conn.commit()
-    finally:
-        conn.close()
+    with conn:
+        conn.execute(_UPDATE_LIKE_BACK_STATUS_SQL, (user_page_url, like_count, _now_jst_iso()))
 
 # --- User Engagement Table Functions ---
 
@@ -1310,8 +1641,6 @@ def get_latest_engagement_timestamp() -> datetime:
             return datetime.fromisoformat(result)
     except (sqlite3.Error, TypeError, ValueError) as e:
         logging.warning(f"エンゲージメントの最新タイムスタンプ取得中にエラー: {e}")
-    finally:
-        conn.close()
     return datetime.min
 
 def get_users_for_url_acquisition() -> list[dict]:
@@ -1322,25 +1651,22 @@ def get_users_for_url_acquisition() -> list[dict]:
     - 優先度順にソート
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM user_engagement
-            WHERE (profile_page_url IS NULL OR profile_page_url = '')
-                AND (
-                    recent_like_count >= 3
-                    OR (is_following > 0 AND recent_follow_count > 0 AND recent_like_count >= 1)
-                )
-            ORDER BY 
-                (CASE WHEN recent_follow_count > 0 THEN 1 ELSE 0 END) DESC,
-                recent_like_count DESC,
-                recent_collect_count DESC,
-                latest_action_timestamp DESC
-        """)
-        users = [dict(row) for row in cursor.fetchall()]
-        return users
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute("""
+        SELECT * FROM user_engagement
+        WHERE (profile_page_url IS NULL OR profile_page_url = '')
+            AND (
+                recent_like_count >= 3
+                OR (is_following > 0 AND recent_follow_count > 0 AND recent_like_count >= 1)
+            )
+        ORDER BY 
+            (CASE WHEN recent_follow_count > 0 THEN 1 ELSE 0 END) DESC,
+            recent_like_count DESC,
+            recent_collect_count DESC,
+            latest_action_timestamp DESC
+    """)
+    return _rows_as_dicts(cursor)
 
 def get_users_for_prompt_creation() -> list[dict]:
     """
@@ -1350,28 +1676,25 @@ def get_users_for_prompt_creation() -> list[dict]:
     - かつ、最後にコメントしてから3日以上経過している、または新規ユーザー
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        three_days_ago = (datetime.now() - timedelta(days=3)).isoformat()
-
-        cursor.execute("""
-            SELECT * FROM user_engagement
-            WHERE 
-                profile_page_url IS NOT NULL
-                AND (
-                    -- 条件1: 新規コメント対象 (フォロー済み & 新規フォロー & いいね1件以上)
-                    (last_commented_at IS NULL AND is_following = 1 AND recent_follow_count > 0 AND recent_like_count >= 1)
-                    OR
-                    -- 条件2: 再コメント対象 (最終コメントから3日以上経過 & いいね5件以上)
-                    (last_commented_at IS NOT NULL AND last_commented_at < ? AND recent_like_count >= 5)
-                )
-                -- 既にプロンプトが最新の場合は除外
-                AND (ai_prompt_updated_at IS NULL OR ai_prompt_updated_at < latest_action_timestamp)
-        """, (three_days_ago,))
-        users = [dict(row) for row in cursor.fetchall()]
-        return users
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    three_days_ago = (datetime.now() - timedelta(days=3)).isoformat()
+
+    cursor.execute("""
+        SELECT * FROM user_engagement
+        WHERE 
+            profile_page_url IS NOT NULL
+            AND (
+                -- 条件1: 新規コメント対象 (フォロー済み & 新規フォロー & いいね1件以上)
+                (last_commented_at IS NULL AND is_following = 1 AND recent_follow_count > 0 AND recent_like_count >= 1)
+                OR
+                -- 条件2: 再コメント対象 (最終コメントから3日以上経過 & いいね5件以上)
+                (last_commented_at IS NOT NULL AND last_commented_at < ? AND recent_like_count >= 5)
+            )
+            -- 既にプロンプトが最新の場合は除外
+            AND (ai_prompt_updated_at IS NULL OR ai_prompt_updated_at < latest_action_timestamp)
+    """, (three_days_ago,))
+    users = [dict(row) for row in cursor.fetchall()]
+    return users
 
 def update_engagement_error(user_id: str, error_message: str):
     """
@@ -1379,30 +1702,39 @@ def update_engagement_error(user_id: str, error_message: str):
     """
     conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE user_engagement SET last_engagement_error = ? WHERE id = ?", (error_message, user_id))
-        conn.commit()
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE user_engagement SET last_engagement_error = ? WHERE id = ?", (error_message, user_id))
         logging.warning(f"ユーザーID: {user_id} のエンゲージメントエラーを記録しました: {error_message}")
     except sqlite3.Error as e:
         logging.error(f"ユーザーID: {user_id} のエンゲージメントエラー記録中にエラー: {e}")
-    finally:
-        conn.close()
 
-def get_all_user_engagements_map() -> dict:
+# get_all_user_engagements_map で一度に読み込む行数
+_ENGAGEMENT_MAP_FETCH_SIZE = 1000
+
+def get_all_user_engagements_map(columns: list[str] | None = None) -> dict:
     """
     user_engagementテーブルからすべてのユーザーデータを取得し、user_idをキーとする辞書で返す。
+    :param columns: 取得するカラム名のリスト。省略時は全カラム。id は常に含まれる。
     """
+    select_cols = "*" if not columns else ", ".join(dict.fromkeys(['id', *columns]))
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM user_engagement")
-        rows = cursor.fetchall()
-        return {row['id']: dict(row) for row in rows}
+        # タプルで受け取り、カラム名は cursor.description から1度だけ取り出して辞書にする
+        cursor.row_factory = None
+        cursor.execute(f"SELECT {select_cols} FROM user_engagement")
+        column_names = [d[0] for d in cursor.description]
+        id_index = column_names.index('id')
+        # fetchall() で全行を一度に保持せず、一定件数ずつ読み込んで辞書に詰める
+        result = {}
+        while rows := cursor.fetchmany(_ENGAGEMENT_MAP_FETCH_SIZE):
+            for row in rows:
+                result[row[id_index]] = dict(zip(column_names, row))
+        return result
     except sqlite3.Error as e:
         logging.error(f"すべてのエンゲージメントデータ取得中にエラー: {e}")
         return {}
-    finally:
-        conn.close()
 
 def bulk_upsert_user_engagements(users_data: list[dict]):
     """
@@ -1423,7 +1755,7 @@ def bulk_upsert_user_engagements(users_data: list[dict]):
     ]
 
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
         # 存在しない場合はINSERT、存在する場合は指定したカラムのみをUPDATE
         cursor.executemany("""
@@ -1451,11 +1783,8 @@ def bulk_upsert_user_engagements(users_data: list[dict]):
                 ai_prompt_message = excluded.ai_prompt_message,
                 ai_prompt_updated_at = excluded.ai_prompt_updated_at
         """, records_to_upsert)
-        conn.commit()
-        logging.debug(f"{cursor.rowcount}件のユーザーエンゲージメントデータをUPSERTしました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+    logging.debug(f"{cursor.rowcount}件のユーザーエンゲージメントデータをUPSERTしました。")
+    return cursor.rowcount
 
 def bulk_update_user_profiles(users_data: list[dict]):
     """
@@ -1475,7 +1804,7 @@ def bulk_update_user_profiles(users_data: list[dict]):
     ]
 
     conn = get_db_connection()
-    try:
+    with conn:
         cursor = conn.cursor()
         # 存在する場合に指定したカラムのみをUPDATE
         cursor.executemany("""
@@ -1485,21 +1814,37 @@ def bulk_update_user_profiles(users_data: list[dict]):
                 ai_prompt_updated_at = COALESCE(?, ai_prompt_updated_at)
             WHERE id = ?
         """, records_to_update)
-        conn.commit()
-        logging.debug(f"{cursor.rowcount}件のユーザープロフィール情報を更新しました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+    logging.debug(f"{cursor.rowcount}件のユーザープロフィール情報を更新しました。")
+    return cursor.rowcount
 
 def cleanup_old_user_engagements(days: int = 30):
     """指定した日数より古いエンゲージメントデータを削除する"""
     threshold_date = datetime.now() - timedelta(days=days)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM user_engagement WHERE latest_action_timestamp < ?", (threshold_date.isoformat(),))
-    conn.commit()
+    # with conn: で成功時はCOMMIT、例外時はROLLBACKされる
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM user_engagement WHERE latest_action_ts_epoch < ?", (_to_epoch_seconds(threshold_date),))
     logging.info(f"{cursor.rowcount}件の古いエンゲージメントデータを削除しました（{days}日以上経過）。")
-    conn.close()
+
+# commit_user_actions 用のSQL。対象IDはJSON配列1つとしてバインドし、件数によらずSQL文字列を固定にする
+_COMMIT_SQL_SET_CLAUSE = """
+    like_count = like_count + recent_like_count,
+    collect_count = collect_count + recent_collect_count,
+    comment_count = comment_count + recent_comment_count,
+    follow_count = follow_count + recent_follow_count,
+    recent_like_count = 0,
+    recent_collect_count = 0,
+    recent_comment_count = 0,
+    recent_follow_count = 0,
+    last_engagement_error = NULL
+"""
+_COMMIT_SQL_PLAIN = f"UPDATE user_engagement SET {_COMMIT_SQL_SET_CLAUSE} WHERE id IN (SELECT value FROM json_each(?))"
+# last_commented_at は datetime.now().isoformat() と同じくローカル時刻のISO形式 (ミリ秒まで) でSQL側で生成する
+_COMMIT_SQL_WITH_COMMENT = (
+    f"UPDATE user_engagement SET {_COMMIT_SQL_SET_CLAUSE}, "
+    "last_commented_at = strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'), last_commented_post_url = ? "
+    "WHERE id IN (SELECT value FROM json_each(?))"
+)
 
 def commit_user_actions(user_ids: list[str], is_comment_posted: bool, post_url: str | None = None):
     """
@@ -1509,35 +1854,15 @@ def commit_user_actions(user_ids: list[str], is_comment_posted: bool, post_url:
     if not user_ids:
         return 0
     
-    conn = get_db_connection()
-    try:
+    user_ids_json = json.dumps(user_ids)
+    with get_db_connection() as conn:
         cursor = conn.cursor()
-        placeholders = ','.join('?' for _ in user_ids)
-        
-        update_query = f"""
-            UPDATE user_engagement SET
-                like_count = like_count + recent_like_count,
-                collect_count = collect_count + recent_collect_count,
-                comment_count = comment_count + recent_comment_count,
-                follow_count = follow_count + recent_follow_count,
-                recent_like_count = 0,
-                recent_collect_count = 0,
-                recent_comment_count = 0,
-                recent_follow_count = 0,
-                last_engagement_error = NULL
-            WHERE id IN ({placeholders})
-        """
         if is_comment_posted:
-            update_query = update_query.replace("WHERE", ", last_commented_at = ?, last_commented_post_url = ? WHERE")
-            params = [datetime.now().isoformat(), post_url] + user_ids
+            cursor.execute(_COMMIT_SQL_WITH_COMMENT, (post_url, user_ids_json))
         else:
-            params = user_ids
-        cursor.execute(update_query, params)
-        conn.commit()
-        logging.debug(f"{cursor.rowcount}件のユーザーアクションをコミットしました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+            cursor.execute(_COMMIT_SQL_PLAIN, (user_ids_json,))
+    logging.debug(f"{cursor.rowcount}件のユーザーアクションをコミットしました。")
+    return cursor.rowcount
 
 def get_stale_user_ids_for_commit(hours: int = 24) -> list[str]:
     """
@@ -1546,64 +1871,43 @@ def get_stale_user_ids_for_commit(hours: int = 24) -> list[str]:
     - recent_action_timestamp が指定時間より前
     - かつ、未コミットのアクション (recent_like_countなど) が存在する
     """
-    threshold_time = (datetime.now() - timedelta(hours=hours)).isoformat()
+    threshold_time = _to_epoch_seconds(datetime.now() - timedelta(hours=hours))
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        query = """
-            SELECT id FROM user_engagement
-            WHERE
-                recent_action_timestamp < ?
-                AND (recent_like_count > 0 OR recent_collect_count > 0 OR recent_comment_count > 0 OR recent_follow_count > 0)
-        """
-        cursor.execute(query, (threshold_time,))
-        user_ids = [row['id'] for row in cursor.fetchall()]
-        return user_ids
-    finally:
-        conn.close()
-
-def _add_engagement_type_to_users(users: list[dict]) -> list[dict]:
-    """ユーザーデータのリストにエンゲージメントタイプを追加するヘルパー関数"""
-    three_days_ago = datetime.now() - timedelta(days=3)
-    processed_users = []
-    for user in users:
-        user['engagement_type'] = 'none'  # デフォルト
-        
-        # --- 判定に必要な変数を準備 ---
-        recent_likes = user.get('recent_like_count', 0)
-        recent_follows = user.get('recent_follow_count', 0)
-        is_following = user.get('is_following', 0) == 1
-        last_commented_at_str = user.get('last_commented_at')
-        last_commented_at = datetime.fromisoformat(last_commented_at_str) if last_commented_at_str else None
-        has_comment_text = bool(user.get('comment_text'))
-
-        # --- コメント対象(💬)の判定 ---
-        is_comment_target = False
-        # 1. 共通の前提条件: コメント本文があり、かつ3日間の再コメント期間をクリアしている
-        can_comment_today = has_comment_text and (not last_commented_at or last_commented_at < three_days_ago)
-
-        if can_comment_today:
-            # 2. 個別の条件: 条件Aまたは条件Bを満たすか
-            # 条件A: いいね5件以上
-            is_like_based_target = (recent_likes >= 5)
-            # 条件B: フォロー済み & 新規フォローバック & いいね1件以上
-            is_follow_based_target = (is_following and recent_follows > 0 and recent_likes >= 1)
-
-            if is_like_based_target or is_follow_based_target:
-                is_comment_target = True
-
-        if is_comment_target:
-            user['engagement_type'] = 'comment'
-        # --- いいね返しのみ対象(❤️)の判定 ---
-        # コメント対象ではなく、かつ、いいねが3件以上ある場合
-        elif recent_likes >= 3:
-            user['engagement_type'] = 'like_only'
-
-        # どちらかの対象であればリストに追加
-        if user['engagement_type'] != 'none':
-            processed_users.append(user)
-
-    return processed_users
+    cursor = conn.cursor()
+    query = """
+        SELECT id FROM user_engagement
+        WHERE
+            recent_action_ts_epoch < ?
+            AND (recent_like_count > 0 OR recent_collect_count > 0 OR recent_comment_count > 0 OR recent_follow_count > 0)
+    """
+    cursor.execute(query, (threshold_time,))
+    # fetchall() で中間リストを作らず、カーソルを直接イテレートする
+    return [row[0] for row in cursor]
+
+# コメント管理画面・エンゲージメント系タスクで参照するカラム (SELECT * を避けて転送量を抑える)
+# engagement_type の判定 (_ENGAGEMENT_TYPE_CASE_SQL) に必要なカラムも含む
+# 変更する場合はカバリングインデックス idx_ue_comment_cover (init_db) も合わせて更新すること
+_ENGAGEMENT_LIST_COLUMNS = """
+    id, name, profile_page_url, profile_image_url, like_count, follow_count, is_following,
+    latest_action_timestamp, recent_like_count, recent_follow_count, recent_action_timestamp,
+    comment_text, last_commented_at, last_commented_post_url, last_engagement_error
+"""
+
+# エンゲージメントタイプの判定式 (パラメータ: 3日前のISO形式日時)
+# - 'comment': コメント本文があり、最終コメントから3日以上経過（または新規）しており、
+#              条件A (いいね5件以上) または 条件B (フォロー済み & 新規フォローバック & いいね1件以上) を満たす
+# - 'like_only': コメント対象ではなく、いいねが3件以上
+# - 'none': どちらの対象でもない
+_ENGAGEMENT_TYPE_CASE_SQL = """
+    CASE
+        WHEN comment_text IS NOT NULL AND comment_text != ''
+            AND (last_commented_at IS NULL OR last_commented_at = '' OR last_commented_at < ?)
+            AND (recent_like_count >= 5 OR (is_following = 1 AND recent_follow_count > 0 AND recent_like_count >= 1))
+        THEN 'comment'
+        WHEN recent_like_count >= 3 THEN 'like_only'
+        ELSE 'none'
+    END
+"""
 
 def get_users_for_commenting(limit: int = 10) -> list[dict]:
     """
@@ -1622,29 +1926,28 @@ def get_users_for_commenting(limit: int = 10) -> list[dict]:
     :return: ユーザーデータの辞書のリスト
     """
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        # コメント対象またはいいね返しの可能性があるユーザーを幅広く取得
-        # - 最近のアクションがある (recent_like_count > 0)
-        # - または、コメントが生成されている (comment_text IS NOT NULL)
-        query = """
-            SELECT * FROM user_engagement
+    cursor = conn.cursor()
+    # コメント対象またはいいね返しの可能性があるユーザーを幅広く取得
+    # - 最近のアクションがある (recent_like_count > 0)
+    # - または、コメントが生成されている (comment_text IS NOT NULL)
+    # engagement_type をSQL側で判定し、対象外のユーザーを除外する
+    query = f"""
+        SELECT * FROM (
+            SELECT {_ENGAGEMENT_LIST_COLUMNS}, {_ENGAGEMENT_TYPE_CASE_SQL} AS engagement_type
+            FROM user_engagement
             WHERE
                 -- 条件A,B,いいね返し対象のいずれかに合致する可能性のあるユーザーを幅広く取得
                 -- (フォローバック+いいね1件 or いいね3件以上)
                 (is_following = 1 AND recent_follow_count > 0 AND recent_like_count >= 1)
                 OR (recent_like_count >= 3)
-            ORDER BY recent_action_timestamp DESC
-        """
-        cursor.execute(query)
-        potential_users = [dict(row) for row in cursor.fetchall()]
-
-        # ヘルパー関数で engagement_type を判定し、対象外のユーザーを除外
-        target_users = _add_engagement_type_to_users(potential_users)
-
-        return target_users[:limit]
-    finally:
-        conn.close()
+        )
+        WHERE engagement_type != 'none'
+        ORDER BY recent_action_timestamp DESC
+        LIMIT ?
+    """
+    three_days_ago = (datetime.now() - timedelta(days=3)).isoformat()
+    cursor.execute(query, (three_days_ago, limit))
+    return [dict(row) for row in cursor.fetchall()]
 
 def get_users_for_ai_comment_creation() -> list[dict]:
     """
@@ -1654,24 +1957,64 @@ def get_users_for_ai_comment_creation() -> list[dict]:
     2. 再生成対象: ai_prompt_updated_at が comment_generated_at より新しい
     """
     conn = get_db_connection()
-    try:
-        
-        cursor = conn.cursor()
-        query = """
-            SELECT * FROM user_engagement
-            WHERE 
-                ai_prompt_message IS NOT NULL AND ai_prompt_message != ''
-                AND (
-                    comment_generated_at IS NULL 
-                    OR ai_prompt_updated_at > comment_generated_at
-                )
-        """
-        cursor.execute(query)
-
-        users = [dict(row) for row in cursor.fetchall()]
-        return users
-    finally:
-        conn.close()
+    
+    cursor = conn.cursor()
+    query = """
+        SELECT id, name, ai_prompt_message, ai_prompt_updated_at, comment_generated_at, recent_action_timestamp
+        FROM user_engagement
+        WHERE 
+            ai_prompt_message IS NOT NULL AND ai_prompt_message != ''
+            AND (
+                comment_generated_at IS NULL 
+                OR ai_prompt_updated_at > comment_generated_at
+            )
+    """
+    cursor.execute(query)
+
+    users = [dict(row) for row in cursor.fetchall()]
+    return users
+
+# get_all_user_engagements 用のクエリ。ソート条件ごとの (WHERE句, ORDER BY句, engagement_typeで絞り込むか) を定義し、
+# (sort_by, 検索方法) の組み合わせごとにSQL文字列をモジュール読み込み時に組み立てておく。
+# 呼び出しごとに同一のSQL文字列となるため、SQLiteのステートメントキャッシュが効く。
+_ENGAGEMENT_SORT_SPECS = {
+    # 「全員表示」系のソート条件は絞り込みを行わず、全ユーザーを返す
+    'all': (None, "ORDER BY latest_action_timestamp DESC", False),
+    'recent_action': (None, "ORDER BY latest_action_timestamp DESC", False),
+    'like_count_desc': (None, "ORDER BY total_like_count DESC", False),
+    # 'commented_at_desc' と 'commented_at_asc' は 'commented' と同じ絞り込み条件
+    'commented_at_desc': ("last_commented_at IS NOT NULL", "ORDER BY last_commented_at DESC", False),
+    'commented_at_asc': ("last_commented_at IS NOT NULL", "ORDER BY last_commented_at ASC", False),
+    # いいね返し対象も最新アクション順で表示
+    'like_back_ready': ("profile_page_url IS NOT NULL AND profile_page_url != '取得失敗'", "ORDER BY latest_action_timestamp DESC", False),
+    # コメント対象者表示: エンゲージメントタイプを判定して絞り込む
+    'commented': ("last_commented_at IS NOT NULL", "ORDER BY last_commented_at DESC", True),
+    # 未知のソート条件: 最新アクション日時順で、エンゲージメントタイプを判定して絞り込む
+    None: (None, "ORDER BY latest_action_timestamp DESC", True),
+}
+
+# trigram トークナイザは3文字未満の検索語では検索できないため、短いキーワードは LIKE で検索する
+_FTS_MIN_KEYWORD_LENGTH = 3
+
+def _build_engagement_query(where_clause: str | None, order_by_clause: str, search_mode: str | None, with_engagement_type: bool) -> str:
+    where_clauses = [where_clause] if where_clause else []
+    if search_mode == 'fts':
+        where_clauses.append("rowid IN (SELECT rowid FROM user_engagement_fts WHERE user_engagement_fts MATCH ?)")
+    elif search_mode == 'like':
+        where_clauses.append("name LIKE ?")
+    where_clause_str = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
+    if with_engagement_type:
+        return (
+            f"SELECT * FROM (SELECT {_ENGAGEMENT_LIST_COLUMNS}, {_ENGAGEMENT_TYPE_CASE_SQL} AS engagement_type "
+            f"FROM user_engagement {where_clause_str}) WHERE engagement_type != 'none' {order_by_clause} LIMIT ?"
+        )
+    return f"SELECT {_ENGAGEMENT_LIST_COLUMNS} FROM user_engagement {where_clause_str} {order_by_clause} LIMIT ?"
+
+_ENGAGEMENT_QUERY_VARIANTS = {
+    (sort_by, search_mode): (_build_engagement_query(where_clause, order_by_clause, search_mode, with_engagement_type), with_engagement_type)
+    for sort_by, (where_clause, order_by_clause, with_engagement_type) in _ENGAGEMENT_SORT_SPECS.items()
+    for search_mode in (None, 'like', 'fts')
+}
 
 def get_all_user_engagements(sort_by: str = 'recent_action', limit: int = 100, search_keyword: str = '') -> list[dict]:
     """
@@ -1687,71 +2030,57 @@ def get_all_user_engagements(sort_by: str = 'recent_action', limit: int = 100, s
     :param limit: 取得する最大件数。
     :return: ユーザーデータの辞書のリスト。
     """
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-
-        # ソート条件に応じてORDER BY句とWHERE句を決定
-        where_clauses = []
-        order_by_clause = "ORDER BY latest_action_timestamp DESC" # デフォルト
-
-        if sort_by == 'all' or sort_by == 'recent_action':
-            # 全員表示の場合は絞り込みなし、デフォルトのソート順を維持
-            pass
-        elif sort_by == 'commented':
-            where_clauses.append("last_commented_at IS NOT NULL")
-            order_by_clause = "ORDER BY last_commented_at DESC"
-        elif sort_by == 'like_count_desc':
-            order_by_clause = "ORDER BY (like_count + recent_like_count) DESC"
-        # 'commented_at_desc' と 'commented_at_asc' は 'commented' と同じ絞り込み条件
-        elif sort_by == 'commented_at_desc':
-            where_clauses.append("last_commented_at IS NOT NULL")
-            order_by_clause = "ORDER BY last_commented_at DESC"
-        elif sort_by == 'like_back_ready':
-            where_clauses.append("profile_page_url IS NOT NULL AND profile_page_url != '取得失敗'")
-            order_by_clause = "ORDER BY latest_action_timestamp DESC" # いいね返し対象も最新アクション順で表示
-        elif sort_by == 'commented_at_asc':
-            where_clauses.append("last_commented_at IS NOT NULL")
-            order_by_clause = "ORDER BY last_commented_at ASC"
-
-        # 検索キーワードがあればWHERE句に追加
-        params = []
-        if search_keyword:
-            where_clauses.append("name LIKE ?")
-            params.append(f'%{search_keyword}%')
-
-        where_clause_str = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
-        params.append(limit)
-
-        query = f"SELECT * FROM user_engagement {where_clause_str} {order_by_clause} LIMIT ?"
-        
-        logging.debug(f"[DB:get_all_user_engagements] Executing query: `{query}` with params: {params}")
-        cursor.execute(query, params)
-        users = [dict(row) for row in cursor.fetchall()]
+    if not search_keyword:
+        search_mode = None
+    elif len(search_keyword) >= _FTS_MIN_KEYWORD_LENGTH:
+        search_mode = 'fts'
+    else:
+        search_mode = 'like'
+    query, with_engagement_type = _ENGAGEMENT_QUERY_VARIANTS.get((sort_by, search_mode)) or _ENGAGEMENT_QUERY_VARIANTS[(None, search_mode)]
+    params = []
+    if with_engagement_type:
+        params.append((datetime.now() - timedelta(days=3)).isoformat())
+    if search_mode == 'fts':
+        # フレーズとして検索し、部分一致させる (記号はFTS5の構文として解釈させない)
+        params.append('"' + search_keyword.replace('"', '""') + '"')
+    elif search_mode == 'like':
+        params.append(f'%{search_keyword}%')
+    params.append(limit)
 
-        # 「全員表示」の場合は絞り込みを行わず、全ユーザーを返す
-        # それ以外（コメント対象者表示など）の場合は、エンゲージメントタイプを判定して絞り込む
-        # `like_back_ready` も全員表示のソートオプションなので、絞り込み対象から除外する
-        if sort_by not in ['all', 'recent_action', 'like_count_desc', 'commented_at_desc', 'commented_at_asc', 'like_back_ready']:
-            users = _add_engagement_type_to_users(users)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    logging.debug(f"[DB:get_all_user_engagements] Executing query: `{query}` with params: {params}")
+    cursor.execute(query, params)
+    return [dict(row) for row in cursor.fetchall()]
 
-        return users
-    finally:
-        conn.close()
 
+_UPDATE_COMMENT_SQL = "UPDATE user_engagement SET comment_text = ?, comment_generated_at = ? WHERE id = ?"
 
 def update_user_comment(user_id: str, comment_text: str):
     """
     指定されたユーザーのcomment_textとcomment_generated_atを更新する。
     """
     now_str = datetime.now().isoformat()
-    conn = get_db_connection()
-    try:
+    with get_db_connection() as conn:
+        conn.execute(_UPDATE_COMMENT_SQL, (comment_text, now_str, user_id))
+
+def bulk_update_user_comments(comments: list[tuple[str, str]]):
+    """
+    複数のユーザーのcomment_textとcomment_generated_atを一括で更新する。
+    :param comments: (user_id, comment_text) のタプルのリスト
+    :return: 更新された行数
+    """
+    if not comments:
+        return 0
+
+    now_str = datetime.now().isoformat()
+    records_to_update = [(comment_text, now_str, user_id) for user_id, comment_text in comments]
+
+    with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE user_engagement SET comment_text = ?, comment_generated_at = ? WHERE id = ?", (comment_text, now_str, user_id))
-        conn.commit()
-    finally:
-        conn.close()
+        cursor.executemany(_UPDATE_COMMENT_SQL, records_to_update)
+    logging.debug(f"{cursor.rowcount}件のユーザーコメントを更新しました。")
+    return cursor.rowcount
 
 def reset_products_for_caption_regeneration(product_ids: list[int]):
     """
@@ -1762,32 +2091,32 @@ def reset_products_for_caption_regeneration(product_ids: list[int]):
     if not product_ids:
         return 0
     conn = get_db_connection()
-    try:
-        placeholders = ','.join('?' for _ in product_ids)
-        query = f"""
-            UPDATE products SET
-                ai_caption = NULL,
-                ai_caption_created_at = NULL,
-                status = 'URL取得済'
-            WHERE id IN ({placeholders})
-        """
+    # IDリストはJSON配列1つとしてバインドし、件数によらずSQL文字列を固定にする
+    query = """
+        UPDATE products SET
+            ai_caption = NULL,
+            ai_caption_created_at = NULL,
+            status = 'URL取得済'
+        WHERE id IN (SELECT value FROM json_each(?))
+    """
+    with conn:
         cursor = conn.cursor()
-        cursor.execute(query, product_ids)
-        conn.commit()
-        logging.info(f"{cursor.rowcount}件の商品を投稿文再生成のためにリセットしました。")
-        return cursor.rowcount
-    finally:
-        conn.close()
+        cursor.execute(query, (json.dumps(product_ids),))
+    logging.info(f"{cursor.rowcount}件の商品を投稿文再生成のためにリセットしました。")
+    return cursor.rowcount
 
 def get_table_names() -> list[str]:
     """データベース内のすべてのテーブル名を取得する。"""
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
-        return [row['name'] for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor = conn.cursor()
+    # 全文検索インデックス (user_engagement_fts とその内部テーブル) と、トリガーで維持する
+    # ステータス別件数 (product_status_counts) は派生データのため除外する
+    cursor.execute("""
+        SELECT name FROM sqlite_master
+        WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE 'user_engagement_fts%'
+          AND name != 'product_status_counts'
+    """)
+    return [row['name'] for row in cursor.fetchall()]
 
 def export_tables_as_sql(table_names: list[str], include_delete: bool) -> str:
     """
@@ -1798,72 +2127,90 @@ def export_tables_as_sql(table_names: list[str], include_delete: bool) -> str:
         return "-- テーブルが選択されていません。"
 
     conn = get_db_connection()
-    try:
-        sql_dump = ["-- R-Auto DB Export", f"-- Generated at: {datetime.now().isoformat()}", "", "BEGIN TRANSACTION;"]
-        
-        # iterdump()はテーブル名がダブルクォートで囲まれるため、それに合わせる
-        # 例: 'CREATE TABLE "products" ...'
-        # iterdump()はテーブル定義(CREATE TABLE)とデータ(INSERT)を両方出力する
-        dump_lines = list(conn.iterdump())
-
-        for table_name in table_names:
-            if include_delete:
-                sql_dump.append(f"DELETE FROM {table_name};")
-            
-            # 指定されたテーブルに関連するINSERT文のみを抽出して追加
-            for line in dump_lines:
-                # INSERT文を INSERT OR IGNORE に置換して、インポート時の重複エラーを防ぐ
-                if line.startswith(f'INSERT INTO "{table_name}"') or line.startswith(f'INSERT INTO {table_name}'):
-                    line = line.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
-                    sql_dump.append(line)
-        
-        sql_dump.append("COMMIT;")
+    sql_dump = ["-- R-Auto DB Export", f"-- Generated at: {datetime.now().isoformat()}", "", "BEGIN TRANSACTION;"]
+    
+    # iterdump()はテーブル名がダブルクォートで囲まれるため、それに合わせる
+    # 例: 'CREATE TABLE "products" ...'
+    # iterdump()はテーブル定義(CREATE TABLE)とデータ(INSERT)を両方出力する
+    dump_lines = list(conn.iterdump())
+
+    for table_name in table_names:
+        if include_delete:
+            sql_dump.append(f"DELETE FROM {table_name};")
         
-        return "\n".join(sql_dump)
-    finally:
-        conn.close()
+        # 指定されたテーブルに関連するINSERT文のみを抽出して追加
+        for line in dump_lines:
+            # INSERT文を INSERT OR IGNORE に置換して、インポート時の重複エラーを防ぐ
+            if line.startswith(f'INSERT INTO "{table_name}"') or line.startswith(f'INSERT INTO {table_name}'):
+                line = line.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
+                sql_dump.append(line)
+    
+    sql_dump.append("COMMIT;")
+    
+    return "\n".join(sql_dump)
+
+def _rebuild_derived_tables_after_script(conn):
+    """
+    スクリプト実行後に、ステータス別件数と全文検索インデックスを元のテーブルから作り直す。
+    以前のエクスポートに product_status_counts が含まれていた場合など、件数が実データとずれないようにする。
+    復元で user_engagement の rowid が振り直された場合も、検索結果が別のユーザーを指さないようにする
+    """
+    with conn:
+        _rebuild_product_status_counts(conn.cursor())
+        conn.execute("INSERT INTO user_engagement_fts(user_engagement_fts) VALUES ('rebuild')")
 
 def execute_sql_script(sql_script: str) -> bool:
     """指定されたSQLスクリプトを実行する。"""
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.executescript(sql_script)
         conn.commit()
+        _rebuild_derived_tables_after_script(conn)
         return True
     except sqlite3.IntegrityError as e:
+        # 途中で失敗したスクリプトのトランザクションが接続に残らないようにする
+        conn.rollback()
         # 主にバックアップからの復元時に発生する重複エラーは警告としてログに記録し、処理は成功とみなす
         logging.warning(f"SQLスクリプトの実行中に重複エラーが発生しましたが、処理を続行します: {e}")
+        # エラーより前の文は反映済みのため、成功時と同様にステータス別件数と全文検索インデックスを作り直す
+        _rebuild_derived_tables_after_script(conn)
         return True
     except sqlite3.DatabaseError as e:
+        conn.rollback()
         logging.error(f"SQLスクリプトの実行中にエラーが発生しました: {e}")
         # 'database disk image is malformed' エラーの場合、復旧を試みる
         if "malformed" in str(e):
             logging.info("データベースが破損している可能性があるため、復旧を試みます...")
             if recover_database():
                 logging.info("データベースの復旧に成功しました。再度SQLスクリプトを実行します。")
-                # 復旧後、再度実行を試みる
+                # 復旧後、再度実行を試みる (復旧時にプールは破棄されているため新しい接続になる)
                 conn_new = get_db_connection()
                 try:
-                    cursor_new = conn_new.cursor()
-                    cursor_new.executescript(sql_script)
+                    conn_new.executescript(sql_script)
                     conn_new.commit()
-                    return True
-                finally:
-                    conn_new.close()
+                except sqlite3.Error:
+                    conn_new.rollback()
+                    raise
+                _rebuild_derived_tables_after_script(conn_new)
+                return True
             else:
                 logging.error("データベースの復旧に失敗しました。")
         raise e # 他のDBエラーや復旧失敗時は再度例外を発生させる
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
 
 def recover_database() -> bool:
     """破損したデータベースの復旧を試みる"""
+    global _wal_initialized
     backup_path = DB_FILE + ".bak"
+    # ファイルを移動する前に、プール内の接続をすべて閉じる
+    close_all_connections()
     logging.info(f"現在のDBファイルを '{backup_path}' にバックアップします。")
-    if os.path.exists(DB_FILE):
-        os.rename(DB_FILE, backup_path)
+    # WALモードの -wal/-shm ファイルも一緒に移動する (残すと新しいDBファイルに誤って適用されるため)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(DB_FILE + suffix):
+            os.rename(DB_FILE + suffix, backup_path + suffix)
+    # 新しいDBファイルにも journal_mode=WAL を設定し直す
+    _wal_initialized = False
 
     logging.info("新しいDBファイルを作成し、バックアップからデータを復元します。")
     # sqlite3コマンドを使って、バックアップから新しいDBにデータをダンプする
@@ -1876,9 +2223,16 @@ def recover_database() -> bool:
         logging.info("DBの復元が正常に完了しました。")
         # 復元後、スキーマの整合性を保つためにinit_dbを再実行
         init_db()
+        # ダンプからの復元では rowid が振り直されることがあるため、全文検索インデックスを再構築する
+        # 読み出せなかった行があると集計テーブルの件数とずれるため、ステータス別件数も作り直す
+        with get_db_connection() as conn:
+            conn.execute("INSERT INTO user_engagement_fts(user_engagement_fts) VALUES ('rebuild')")
+            _rebuild_product_status_counts(conn)
         return True
     else:
         logging.error(f"DBの復元に失敗しました。コマンド終了コード: {result}")
         # 失敗した場合はバックアップを元に戻す
-        os.rename(backup_path, DB_FILE)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(backup_path + suffix):
+                os.replace(backup_path + suffix, DB_FILE + suffix)
         return False
@@ -1,6 +1,6 @@
 import logging
 import os
-import shutil
+import sqlite3
 from datetime import datetime
 
 from app.core.base_task import BaseTask
@@ -31,7 +31,17 @@ class BackupDatabaseTask(BaseTask):
                 logging.warning(f"バックアップ対象のデータベースファイルが見つかりません: {DB_FILE}")
                 return False
 
-            shutil.copy2(DB_FILE, backup_filepath)
+            # WALモードでは未チェックポイントの更新が -wal ファイルにあるため、
+            # ファイルコピーではなくSQLiteのオンラインバックアップAPIで整合性のあるコピーを作成する
+            src = sqlite3.connect(DB_FILE)
+            try:
+                dst = sqlite3.connect(backup_filepath)
+                try:
+                    src.backup(dst)
+                finally:
+                    dst.close()
+            finally:
+                src.close()
             
             logging.info(f"データベースのバックアップを作成しました: {backup_filepath}")
 
@@ -45,7 +45,6 @@ class BindProductUrlRoomUrlTask(BaseTask):
             else:
                 cursor.execute(base_query)
             rows = cursor.fetchall()
-            conn.close()
             return [dict(r) for r in rows]
 
         def normalize_text(text: str) -> str:
@@ -2,11 +2,12 @@ import logging
 import json
 import os
 import re
+import sqlite3
 from playwright.sync_api import sync_playwright, TimeoutError
 import math
 import time
 from app.core.base_task import BaseTask
-from app.core.database import get_products_for_caption_creation, get_products_count_for_caption_creation, update_ai_caption, update_product_status
+from app.core.database import get_products_for_caption_creation, get_products_count_for_caption_creation, bulk_update_ai_captions, update_status_for_multiple_products
 from app.utils.json_utils import parse_json_with_rescue
 
 PROMPT_FILE = "app/prompts/product_caption_prompt.txt"
@@ -84,7 +85,7 @@ class CreateCaptionTask(BaseTask):
                 except TimeoutError:
                     logging.error(f"バッチ {batch_num}: Geminiの応答待機中にタイムアウトしました。")
                     self._save_debug_info(full_prompt, "gemini_response_timeout")
-                    for product in products: update_product_status(product['id'], 'エラー')
+                    self._mark_batch_as_error(products)
                     total_error_count += len(products)
                     continue
 
@@ -105,12 +106,10 @@ class CreateCaptionTask(BaseTask):
 
                 if generated_items:
                     url_to_caption = {item['page_url']: item.get('ai_caption') for item in generated_items}
-                    updated_count = 0
-                    for product in products:
-                        caption = url_to_caption.get(product['url'])
-                        if caption:
-                            update_ai_caption(product['id'], caption)
-                            updated_count += 1
+                    # バッチ内の投稿文はまとめて1トランザクションで保存する
+                    captions_to_update = [(product['id'], url_to_caption[product['url']]) for product in products if url_to_caption.get(product['url'])]
+                    bulk_update_ai_captions(captions_to_update)
+                    updated_count = len(captions_to_update)
                     total_updated_count += updated_count
                     logging.debug(f"バッチ {batch_num}: {updated_count}件の投稿文をデータベースに保存しました。")
                 else:
@@ -122,11 +121,18 @@ class CreateCaptionTask(BaseTask):
                 is_detailed_log = os.getenv('LOG_FORMAT', 'detailed').lower() == 'detailed' # この行は既に修正済みですが、念のため記載
                 logging.error(f"プロンプトの生成またはコピー中にエラーが発生しました: {e}", exc_info=is_detailed_log)
                 self._save_debug_info(full_prompt, "general_error")
-                for product in products: update_product_status(product['id'], 'エラー', error_message=str(e))
+                self._mark_batch_as_error(products, error_message=str(e))
                 total_error_count += len(products)
         
         return total_updated_count, total_error_count
 
+    def _mark_batch_as_error(self, products: list, error_message: str = None):
+        """バッチの商品をまとめて「エラー」にする。記録に失敗しても、ログに残して次のバッチの処理を続ける"""
+        try:
+            update_status_for_multiple_products([product['id'] for product in products], 'エラー', error_message=error_message)
+        except sqlite3.Error as e:
+            logging.error(f"商品のステータスを「エラー」に更新できませんでした: {e}")
+
     def _save_debug_info(self, prompt_text: str, error_type: str):
         """エラー発生時のデバッグ情報（プロンプトとスクリーンショット）を保存する"""
         try:
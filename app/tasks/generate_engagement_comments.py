@@ -6,7 +6,7 @@ import random
 import time 
 from google import genai
 from app.core.base_task import BaseTask
-from app.core.database import get_users_for_ai_comment_creation, update_user_comment, get_users_for_commenting
+from app.core.database import get_users_for_ai_comment_creation, bulk_update_user_comments, get_users_for_commenting
 from app.core.ai_utils import call_gemini_api_with_retry
 from app.utils.json_utils import parse_json_with_rescue
 
@@ -131,7 +131,7 @@ class GenerateEngagementCommentsTask(BaseTask):
 
             # ステップ3: 最終的な組み立てとDB更新
             logger.debug("--- 最終的なコメントを組み立て、DBを更新します ---")
-            updated_count = 0
+            comments_to_update = []
             for user in users:
                 comment_name = id_to_comment_name.get(user['id'], '')
                 comment_body = id_to_comment_body.get(user['id'], '')
@@ -154,10 +154,12 @@ class GenerateEngagementCommentsTask(BaseTask):
                     else:
                         final_comment = comment_body
 
-                    update_user_comment(user['id'], final_comment)
+                    comments_to_update.append((user['id'], final_comment))
                     logger.debug(f"  -> '{user['name']}'へのコメント生成成功: {final_comment}")
 
-                    updated_count += 1
+            # 生成したコメントはまとめて1トランザクションでDBに保存する
+            bulk_update_user_comments(comments_to_update)
+            updated_count = len(comments_to_update)
 
             logger.debug(f"--- AIコメント作成完了。{updated_count}件のコメントを更新しました。 ---")
 
@@ -6,7 +6,7 @@ import math
 import time
 import random
 import re
-from app.core.database import get_products_for_caption_creation, update_ai_caption,get_products_count_for_caption_creation
+from app.core.database import get_products_for_caption_creation, bulk_update_ai_captions, get_products_count_for_caption_creation
 from google import genai
 from app.core.ai_utils import call_gemini_api_with_retry
 from app.utils.json_utils import parse_json_with_rescue
@@ -77,12 +77,10 @@ class CreateProductCaptionTask(BaseTask):
                 if generated_items:
                     # 'id' がキーで、'ai_caption' が値の辞書を作成
                     id_to_caption = {item.get('id'): item.get('ai_caption') for item in generated_items if item.get('id')}
-                    batch_updated_count = 0
-                    for product in products:
-                        caption = id_to_caption.get(product['id'])
-                        if caption:
-                            update_ai_caption(product['id'], caption)
-                            batch_updated_count += 1
+                    # バッチ内の投稿文はまとめて1トランザクションで保存する
+                    captions_to_update = [(product['id'], id_to_caption[product['id']]) for product in products if id_to_caption.get(product['id'])]
+                    bulk_update_ai_captions(captions_to_update)
+                    batch_updated_count = len(captions_to_update)
                     logging.debug(f"バッチ {batch_num}: {batch_updated_count}件の投稿文をデータベースに保存しました。")
                     total_updated_count += batch_updated_count
                 else:
@@ -5,7 +5,7 @@ import re
 import random
 import time
 from app.core.base_task import BaseTask
-from app.core.database import get_post_urls_with_unreplied_comments, get_unreplied_comments_for_post, bulk_update_comment_replies
+from app.core.database import get_unreplied_comments_grouped_by_post, bulk_update_comment_replies
 from app.core.ai_utils import call_gemini_api_with_retry
 from app.utils.json_utils import parse_json_with_rescue
 from google import genai
@@ -38,10 +38,11 @@ class GenerateMyRoomRepliesTask(BaseTask):
             logger.error(f"プロンプトファイルが見つかりません: {PROMPT_FILE_PATH}")
             return False
 
-        # 1. 未返信コメントを持つ投稿URLのリストを取得
-        post_urls_to_process = get_post_urls_with_unreplied_comments()
+        # 1. 未返信コメントを投稿URLごとにまとめて取得 (1回のクエリで済ませる)
+        unreplied_comments_by_post = get_unreplied_comments_grouped_by_post()
+        post_urls_to_process = list(unreplied_comments_by_post)
         # ★★★ ここで処理対象の総数を先にカウントする ★★★
-        total_unreplied_count = sum(len(get_unreplied_comments_for_post(url)) for url in post_urls_to_process)
+        total_unreplied_count = sum(len(comments) for comments in unreplied_comments_by_post.values())
 
         if not post_urls_to_process:
             logger.info("返信対象の新しいコメントはありませんでした。")
@@ -58,7 +59,7 @@ class GenerateMyRoomRepliesTask(BaseTask):
             logger.debug(f"--- 投稿 {i+1}/{len(post_urls_to_process)} の処理を開始: {post_url} ---")
             
             # 3. 投稿ごとの未返信コメントを取得
-            comments_data = get_unreplied_comments_for_post(post_url)
+            comments_data = unreplied_comments_by_post[post_url]
             if not comments_data:
                 logger.warning(f"  -> 対象コメントが見つかりませんでした。スキップします。")
                 continue
@@ -129,7 +129,7 @@ class NewCommentBackTask(BaseTask):
             # コメント実行可否を判定
             can_comment = False
             if comment_text:
-                # --- database.py の _add_engagement_type_to_users とロジックを完全に一致させる ---
+                # --- database.py の _ENGAGEMENT_TYPE_CASE_SQL とロジックを完全に一致させる ---
                 three_days_ago = datetime.now() - timedelta(days=3)
                 last_commented_at = datetime.fromisoformat(last_commented_at_str) if last_commented_at_str else None
                 
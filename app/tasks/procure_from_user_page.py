@@ -36,7 +36,6 @@ def product_exists_by_image_url(image_url: str) -> bool:
     cursor = conn.cursor()
     cursor.execute("SELECT 1 FROM products WHERE image_url = ? LIMIT 1", (image_url,))
     exists = cursor.fetchone() is not None
-    conn.close()
     return exists
 
 
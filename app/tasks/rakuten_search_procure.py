@@ -2,7 +2,7 @@ import logging
 import random
 import json
 import os
-from app.core.database import product_exists_by_url
+from app.core.database import get_existing_product_urls
 from app.core.base_task import BaseTask
 from app.tasks.import_products import process_and_import_products
 
@@ -126,6 +126,10 @@ class RakutenSearchProcureTask(BaseTask):
                         logging.debug(f"このキーワード「{keyword}」ではこれ以上商品が見つかりませんでした。次のキーワードに進みます。")
                         break
 
+                    # ページ内の商品URLをまとめて取得し、DBとの重複チェックを1回のクエリで済ませる
+                    page_urls = product_cards.locator("a[class*='image-link-wrapper--']").evaluate_all("els => els.map(e => e.getAttribute('href'))")
+                    existing_urls = get_existing_product_urls(page_urls)
+
                     for i, card in enumerate(product_cards.all()):
                         if len(items) >= self.target_count:
                             break
@@ -135,7 +139,7 @@ class RakutenSearchProcureTask(BaseTask):
 
                         if url_element.count() and image_element.count():
                             page_url = url_element.get_attribute('href')
-                            if product_exists_by_url(page_url):
+                            if page_url in existing_urls:
                                 logging.debug(f"  スキップ(DB重複): この商品は既にDBに存在します。 URL: {page_url[:50]}...")
                                 continue
 
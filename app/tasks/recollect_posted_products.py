@@ -27,7 +27,6 @@ def _fetch_recent_posted_products(limit: int):
     else:
         cursor.execute(base_sql)
     rows = cursor.fetchall()
-    conn.close()
     return [dict(r) for r in rows]
 
 
@@ -17,8 +17,8 @@ import threading
 # タスク定義を一元的にインポート
 from app.core.task_manager import TaskManager
 from app.core.task_definitions import TASK_DEFINITIONS
-from app.core.database import (get_all_inventory_products, update_product_status, delete_all_products, init_db, get_product_by_id,
-                               delete_product, update_status_for_multiple_products, delete_multiple_products, get_product_count_by_status, get_reusable_products, recollect_product, bulk_recollect_products, update_product_post_url, update_product_room_url, get_all_error_products,
+from app.core.database import (get_all_inventory_products, update_product_status, delete_all_products, init_db, get_product_by_id, get_products_by_ids,
+                               delete_product, update_status_for_multiple_products, delete_multiple_products, get_product_count_by_status, get_reusable_products, recollect_product, bulk_recollect_products, update_product_post_url, update_product_room_url, get_all_error_products, get_error_product_count,
                                get_posted_products, get_posted_product_shop_summary, update_product_priority, update_product_order, bulk_update_products_from_data, commit_user_actions, get_all_user_engagements, get_users_for_commenting,
                                update_user_comment, get_generated_replies, update_reply_text, ignore_reply, get_commenting_users_summary,
                                get_table_names, export_tables_as_sql, execute_sql_script)
@@ -521,9 +521,8 @@ async def read_config():
 @router.get("/api/inventory")
 async def get_inventory():
     """在庫商品（「投稿済」以外）のリストをJSONで返す"""
-    products = get_all_inventory_products()
-    # sqlite3.Rowは直接JSONシリアライズできないため、辞書のリストに変換
-    products_list = [dict(product) for product in products]
+    # sqlite3.Rowは直接JSONシリアライズできないため、カーソルから1行ずつ辞書に変換する
+    products_list = [dict(product) for product in get_all_inventory_products()]
     return JSONResponse(content=products_list)
 
 @router.get("/api/posted-products")
@@ -588,11 +587,8 @@ async def api_bulk_recollect_posted_products(request: BulkUpdateRequest, backgro
     if not request.product_ids:
         raise HTTPException(status_code=400, detail="商品IDが指定されていません。")
     
-    products_to_process = []
-    for product_id in request.product_ids:
-        product = get_product_by_id(product_id)
-        if product:
-            products_to_process.append({'id': product_id, 'room_url': product.get('room_url')})
+    # 対象商品は1回のクエリでまとめて取得する
+    products_to_process = [{'id': product['id'], 'room_url': product.get('room_url')} for product in get_products_by_ids(request.product_ids)]
 
     task_manager = TaskManager()
     if products_to_process:
@@ -618,11 +614,8 @@ async def api_bulk_delete_posted_products(request: BulkUpdateRequest, background
     """複数の投稿済商品を削除するタスクを開始する"""
     if not request.product_ids:
         raise HTTPException(status_code=400, detail="商品IDが指定されていません。")
-    products_to_process = []
-    for product_id in request.product_ids:
-        product = get_product_by_id(product_id)
-        if product:
-            products_to_process.append({'id': product_id, 'room_url': product.get('room_url')})
+    # 対象商品は1回のクエリでまとめて取得する
+    products_to_process = [{'id': product['id'], 'room_url': product.get('room_url')} for product in get_products_by_ids(request.product_ids)]
     task_manager = TaskManager()
     if products_to_process:
         background_tasks.add_task(task_manager.run_task_by_tag, "delete-product-flow", products=products_to_process, action='delete')
@@ -666,17 +659,15 @@ async def api_update_posted_product_room_url(product_id: int, request: RoomUrlUp
 @router.get("/api/errors")
 async def get_error_products():
     """エラー商品（過去24時間）のリストをJSONで返す"""
-    products = get_all_error_products()
-    # get_error_products_in_last_24h は既に辞書のリストを返す
-    return JSONResponse(content=products)
+    # get_all_error_products は辞書のリストを返すため、そのままJSONにできる
+    return JSONResponse(content=get_all_error_products())
 
 @router.get("/api/errors/summary")
 async def get_errors_summary():
     """エラー商品数とスクリーンショット数の合計を返す"""
     try:
         # エラー商品数を取得
-        error_products = get_all_error_products()
-        error_product_count = len(error_products)
+        error_product_count = get_error_product_count()
 
         # スクリーンショット数を取得
         screenshot_count = 0
@@ -716,8 +707,7 @@ async def get_dashboard_summary(request: Request):
         log_summary = get_log_summary(period=period)
 
         # 24時間以内のエラー商品数を取得
-        all_error_products = get_all_error_products()
-        total_error_product_count = len(all_error_products)
+        total_error_product_count = get_error_product_count()
 
         # 次のスケジュール情報を最大3件取得
         all_jobs = schedule.get_jobs()
@@ -1199,7 +1189,7 @@ async def api_import_db(request: DbImportRequest):
 async def export_reusable_products():
     """
     procurement_keywordが「再コレ再利用」の商品を抽出し、
-    SQLite用のINSERT OR REPLACEクエリを生成して返す。
+    SQLite用のINSERT ... ON CONFLICT(url) DO UPDATEクエリを生成して返す。
     """
     try:
         # 条件に合う商品をすべて取得
@@ -1208,7 +1198,8 @@ async def export_reusable_products():
         if not products:
             return Response(content="-- 対象となる「再コレ再利用」商品はありませんでした。", media_type="text/plain; charset=utf-8")
 
-        # INSERT OR REPLACE文を生成
+        # INSERT ... ON CONFLICT(url) DO UPDATE文を生成
+        # (INSERT OR REPLACEは既存行を削除して挿入し直すため、行のidが変わり、削除トリガーも発火せずステータス別件数がずれる)
         sql_statements = []
         sql_statements.append("-- 「再コレ再利用」商品データのエクスポート\n")
         sql_statements.append(f"-- {len(products)}件の商品が見つかりました\n")
@@ -1221,6 +1212,8 @@ async def export_reusable_products():
             columns.remove('id')
 
         column_str = ", ".join(f'"{col}"' for col in columns)
+        # urlが重複した場合は、url以外のカラムをエクスポートした値で上書きする
+        update_str = ", ".join(f'"{col}" = excluded."{col}"' for col in columns if col != 'url')
 
         for product in products:
             values = []
@@ -1236,7 +1229,7 @@ async def export_reusable_products():
                     values.append(f"'{escaped_value}'")
             
             values_str = ", ".join(values)
-            sql_statements.append(f"INSERT OR REPLACE INTO products ({column_str}) VALUES ({values_str});")
+            sql_statements.append(f"INSERT INTO products ({column_str}) VALUES ({values_str}) ON CONFLICT(url) DO UPDATE SET {update_str};")
 
         full_sql_script = "\n".join(sql_statements)
         return Response(content=full_sql_script, media_type="text/plain; charset=utf-8")